@@ -1,22 +1,86 @@
 """Backend for handling online analysis of data from caiman."""
 
+import hashlib
+import os
 import warnings
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
+import scipy.sparse
 import scipy.stats as stats
 import json
 import sklearn
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 with warnings.catch_warnings():
     warnings.simplefilter('ignore', category=FutureWarning)
     import caiman as cm
 
+from .timing import trialwise_by_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def load_json(path):
     with open(path, 'r') as file:
         data_json = json.load(file)
     return data_json
 
+def sidecar_path(path):
+    """Path of the binary (.npz) copy of a json result file."""
+    return os.path.splitext(path)[0] + '.npz'
+
+def load_result(path, keys=('c', 'splits'), dtype=np.float32):
+    """
+    Loads the keys needed from one result file, reading it only once. Uses the .npz sidecar if
+    there is one, otherwise parses the json (with orjson if it's installed). Trace data ('c' and
+    'dff') comes back as arrays of dtype.
+
+    Args:
+        path (str): path to the json result file
+        keys (tuple, optional): keys to return. Defaults to ('c', 'splits').
+        dtype (optional): dtype for trace arrays. Defaults to np.float32.
+
+    Returns:
+        dict of the requested keys
+    """
+    npz = sidecar_path(path)
+    if os.path.exists(npz):
+        with np.load(npz) as f:
+            data = {key: f[key] for key in keys}
+    else:
+        with open(path, 'rb') as file:
+            raw = file.read()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        data = {key: data[key] for key in keys}
+
+    for key in ('c', 'dff'):
+        if key in data:
+            data[key] = np.asarray(data[key], dtype=dtype)
+    return data
+
+def load_results(paths, keys=('c', 'splits'), dtype=np.float32, n_workers=None, processes=False):
+    """
+    Loads many result files in parallel (see load_result). Results are in the same order as paths.
+
+    Args:
+        paths (list): paths to the json result files
+        keys (tuple, optional): keys to return. Defaults to ('c', 'splits').
+        dtype (optional): dtype for trace arrays. Defaults to np.float32.
+        n_workers (int, optional): number of workers. Defaults to the executor default.
+        processes (bool, optional): use processes instead of threads, better when parsing json
+                                    without orjson. Defaults to False.
+
+    Returns:
+        list of dicts, one per path
+    """
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers=n_workers) as pool:
+        return list(pool.map(load_result, paths, [keys]*len(paths), [dtype]*len(paths)))
+
 def load_as_obj(caiman_data_path):
     """hdf5 -> caiman object"""
     return cm.source_extraction.cnmf.cnmf.load_CNMF(caiman_data_path)
@@ -30,11 +94,56 @@ def make_traces_from_json(path, *args, **kwargs):
     traces = process_data(data['c'], data['splits'], *args, **kwargs)
     return traces
 
-def make_trialwise(traces, splits):
-    """Returns trial x cell x time."""
-    traces = np.split(traces, np.cumsum(splits[:-1]).astype(np.uint), axis=1)
-    shortest = min([s.shape[1] for s in traces])
-    return np.array([a[:, :shortest] for a in traces])
+def trial_offsets(splits, n_frames):
+    """
+    Start and stop frame of each trial from the file lengths. Like np.split, the last trial gets
+    whatever frames are left.
+    """
+    splits = np.asarray(splits, dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(splits[:-1])]).clip(max=n_frames)
+    stops = np.append(starts[1:], n_frames)
+    return starts, stops
+
+def make_trialwise(traces, splits, mode='truncate'):
+    """
+    Returns trial x cell x time. Gathers every trial straight into one preallocated array instead
+    of splitting and copying each trial.
+
+    Args:
+        traces (array-like): cell x time traces
+        splits (list): file lengths per tiff/trial
+        mode (str, optional): what to do with trials of different lengths. 'truncate' cuts all
+                              trials to the shortest, 'pad' NaN pads them to the longest, and
+                              'ragged' skips the copy and returns (traces, offsets) where trial i
+                              is traces[:, offsets[i]:offsets[i+1]]. Defaults to 'truncate'.
+    """
+    traces = np.asarray(traces)
+    starts, stops = trial_offsets(splits, traces.shape[1])
+
+    if mode == 'ragged':
+        return traces, np.append(starts, stops[-1])
+
+    lengths = stops - starts
+    if mode == 'truncate':
+        length = lengths.min()
+        dtype = traces.dtype
+    elif mode == 'pad':
+        length = lengths.max()
+        dtype = np.result_type(traces.dtype, np.float32)
+        # take can't cast into out, so ints have to become floats first to hold the NaN padding
+        traces = traces.astype(dtype, copy=False)
+    else:
+        raise ValueError(f'Unknown trialwise mode: {mode}')
+
+    idx = starts[:, None] + np.arange(length) # trials x time
+    out = np.empty((starts.size, traces.shape[0], length), dtype=dtype)
+    # write through a cell x trial x time view so the gather lands in place
+    np.take(traces, idx, axis=1, out=out.transpose(1, 0, 2), mode='clip')
+
+    if mode == 'pad':
+        np.copyto(out, np.nan, where=(idx >= stops[:, None])[:, None, :])
+
+    return out
 
 def stim_align_trialwise(traces, times):
     """
@@ -64,20 +173,143 @@ def find_com(A, dims, x_1stPix):
     i = [1, 0]
     return XYcoords[:,i] #swap them
 
-def process_data(c, splits, stim_times=None, normalizer='scale', func=None, *args, **kwargs):
+NORMALIZERS = {}
+
+def register_normalizer(name, func=None, subtract_min=True):
+    """
+    Registers a normalizer so it can be used by name in process_data/normalize. Can be used as a
+    decorator (@register_normalizer('name')) or called directly. Normalizers get a float32 cell x
+    time array they are free to change in place, and return the normalized array.
+
+    Args:
+        name (str): name to use it by
+        func (function, optional): the normalizer, leave out when using as a decorator
+        subtract_min (bool, optional): subtract each cell's min before calling func. Set False
+                                       for normalizers that do it themselves. Defaults to True.
+    """
+    def register(func):
+        NORMALIZERS[name] = (func, subtract_min)
+        return func
+    if func is None:
+        return register
+    return register(func)
+
+def _row_min(data):
+    return data.min(axis=1, keepdims=True)
+
+def _safe(denom):
+    # same as sklearn, leave constant cells alone instead of dividing by 0
+    denom[denom == 0] = 1
+    return denom
+
+# the built-ins do the min subtraction themselves, fused with the normalization where possible
+
+@register_normalizer('none', subtract_min=False)
+def _norm_none(data):
+    """Just min subtracted."""
+    data -= _row_min(data)
+    return data
+
+@register_normalizer('minmax', subtract_min=False)
+def _norm_minmax(data):
+    """Scaled to min max (not abs), same as sklearn.preprocessing.minmax_scale."""
+    low = _row_min(data)
+    data -= low
+    data /= _safe(data.max(axis=1, keepdims=True))
+    return data
+
+@register_normalizer('zscore', subtract_min=False)
+def _norm_zscore(data):
+    """Old fashion zscoring, same as scipy.stats.zscore. The min doesn't matter here."""
+    data -= data.mean(axis=1, keepdims=True)
+    data /= data.std(axis=1, keepdims=True)
+    return data
+
+@register_normalizer('norm', subtract_min=False)
+def _norm_l2(data):
+    """L2 norm, same as sklearn.preprocessing.normalize."""
+    data -= _row_min(data)
+    data /= _safe(np.sqrt(np.einsum('ij,ij->i', data, data))[:, None])
+    return data
+
+@register_normalizer('scale', subtract_min=False)
+def _norm_scale(data):
+    """Mean subtracted, divided by standard dev, same as sklearn.preprocessing.scale."""
+    data -= data.mean(axis=1, keepdims=True)
+    data /= _safe(data.std(axis=1, keepdims=True))
+    return data
+
+def normalize(c, normalizer='scale', copy=True):
+    """
+    Min subtracts and normalizes each cell (row) of c with a registered normalizer. Only the one
+    asked for gets run.
+
+    Args:
+        c (array-like): cell x time data
+        normalizer (str, optional): name of the normalizer. Defaults to 'scale'.
+        copy (bool, optional): if False and c is already a float32 array, works on c in place.
+                               Defaults to True.
+
+    Returns:
+        float32 array of normalized data
+    """
+    try:
+        func, subtract_min = NORMALIZERS[normalizer]
+    except KeyError:
+        raise KeyError(f'Unknown normalizer {normalizer}, options are {list(NORMALIZERS)}')
+
+    data = np.array(c, dtype=np.float32, copy=copy or None)
+    if subtract_min:
+        data -= _row_min(data)
+    return func(data)
+
+def _trialwise_by_frame_times(traces, splits, frame_times, fr=None):
+    """
+    trial_mode='time' for process_data. Trials with no frames come back all NaN. Falls back to
+    evenly spaced frames at fr if frame_times are missing/NaN, or to truncating if there's no fr.
+    """
+    n_frames = traces.shape[1]
+    frame_times = np.asarray(frame_times, dtype=np.float64)[:n_frames]
+    steps = np.diff(frame_times)
+    if frame_times.size == n_frames and np.isfinite(frame_times).all() and (steps > 0).any():
+        fr = 1 / np.median(steps[steps > 0])
+    elif fr:
+        frame_times = np.arange(n_frames) / fr
+    else:
+        warnings.warn('No usable frame times or frame rate, truncating trials instead.')
+        return make_trialwise(traces, splits, mode='truncate')
+
+    starts, stops = trial_offsets(splits, n_frames)
+    has_frames = stops > starts
+    out = np.full((starts.size, traces.shape[0], 0), np.nan, dtype=np.float32)
+    if has_frames.any():
+        resampled = trialwise_by_time(traces, frame_times, frame_times[starts[has_frames]], fr)
+        out = np.full((starts.size,) + resampled.shape[1:], np.nan, dtype=np.float32)
+        out[has_frames] = resampled
+    return out
+
+def process_data(c, splits, stim_times=None, normalizer='scale', func=None, *args,
+                 trial_mode='truncate', frame_times=None, fr=None, **kwargs):
     """
     Processes temporal data (taken from C) by subtracting off min for each cell and then 
-    optionally normalizing it on axis=1 (aka cells). Can use minmax (default), zscore, 
-    normalize, or scale. See sklearn.preprocessing for more info. Alternatively can pass
-    'other' to use a custom function (func) and passes *args and **kwargs to that function.
-    Finally, uses splits to make the data trialwise into trial x cells x time numpy array.
+    optionally normalizing it on axis=1 (aka cells). Can use minmax, zscore, norm, scale
+    (default), none, or anything added with register_normalizer. See normalize. Alternatively
+    can pass 'other' to use a custom function (func) and passes *args and **kwargs to that
+    function. Finally, uses splits to make the data trialwise into trial x cells x time numpy array.
 
     Args:
         c (array-like): temporal data from caiman
         splits (list): file lengths per tiff/trial, taken from memmap file name
         stim_times (array-like): cellwise list of stim times, defaults to None.
-        normalizer (str, optional): Method to normalize traces by. Defaults to 'minmax'.
+        normalizer (str, optional): Method to normalize traces by. Defaults to 'scale'.
         func (function): if normalizer is 'other', can pass in a function here (don't call)
+        trial_mode (str, optional): how to handle trials of different lengths, see make_trialwise.
+                                    'time' resamples every trial onto the same time base from its
+                                    start (see timing.trialwise_by_time), which needs frame_times.
+                                    Defaults to 'truncate'.
+        frame_times (array-like, optional): acquisition time of each frame (column of c)
+        fr (float, optional): frame rate to use for trial_mode='time' if frame_times has no usable
+                              timing (eg. tiffs without timestamps)
         *args and **kwargs get passed to func if 'other'
     """
     
@@ -86,26 +318,23 @@ def process_data(c, splits, stim_times=None, normalizer='scale', func=None, *arg
     if normalizer != 'other' and func is not None:
         warnings.warn('Both named normalizer type and alternate function were provided. Defaulting to named.')
     
-    c = np.array(c)        
-    data = c - c.min(axis=1).reshape(-1,1)
+    c = np.asarray(c)
     
     # normalization routines
     if normalizer == 'other':
+        data = c - c.min(axis=1).reshape(-1,1)
         normed_data = func(data, *args, **kwargs)
     else:
-        norm_routines = {
-            'none': data, # nothing done...
-            'minmax': sklearn.preprocessing.minmax_scale(data, axis=1), # scaled to min max (not abs)
-            'zscore': stats.zscore(data, axis=1), # old fashion zscoring
-            'norm': sklearn.preprocessing.normalize(data, axis=1), # L2 norm
-            'scale': sklearn.preprocessing.scale(data, axis=1), # mean subtracted, divided by standard dev
-        }
-        
-        normed_data = norm_routines[normalizer]
+        normed_data = normalize(c, normalizer)
     
-    traces = make_trialwise(normed_data, splits)
+    if trial_mode == 'time':
+        if frame_times is None:
+            raise ValueError("trial_mode='time' needs frame_times.")
+        traces = _trialwise_by_frame_times(normed_data, splits, frame_times, fr)
+    else:
+        traces = make_trialwise(normed_data, splits, mode=trial_mode)
     
-    if stim_times:
+    if stim_times and trial_mode != 'ragged':
         assert len(stim_times) == c.shape[0] # must have same length/size as the number of cells
         traces = stim_align_trialwise(traces, stim_times)
     
@@ -115,8 +344,9 @@ def concat_chunked_data(jsons, f_src='c', *args, **kwargs):
     """
     Takes chunks of data and combines them into a numpy array
     of shape trial x cells x time, concatendated over trials, and
-    clips the trials at shortest frame number and fewest cells. Args and
-    kwargs are passed to process_data.
+    clips the trials at shortest frame number and fewest cells (or NaN
+    pads to the longest if trial_mode='pad'). Args and kwargs are passed
+    to process_data.
 
     Args:
         jsons (list): list of jsons to process
@@ -125,17 +355,20 @@ def concat_chunked_data(jsons, f_src='c', *args, **kwargs):
     Returns:
         trial_dat: 3D numpy array, (trials, cells, time)
     """
-    # load and format
-    c_trials = [load_json(j)[f_src] for j in jsons]
-    s_trials = [load_json(j)['splits'] for j in jsons]
+    # load and format, each file read once
+    results = load_results(jsons, keys=(f_src, 'splits'))
 
     # smoosh all the lists of trials into a big array
     trial_dat = []
-    for c,s in zip(c_trials, s_trials):
-        out = process_data(c, s, *args, **kwargs)
+    for result in results:
+        out = process_data(result[f_src], result['splits'], *args, **kwargs)
         trial_dat.append(out)
     
     # ensure that trials are the same length and have same 
+    if kwargs.get('trial_mode') == 'pad':
+        longest = max([s.shape[2] for s in trial_dat])
+        trial_dat = [np.pad(a, ((0, 0), (0, 0), (0, longest - a.shape[2])), constant_values=np.nan)
+                     for a in trial_dat]
     shortest = min([s.shape[2] for s in trial_dat]) # shortest trial
     # fewest = min([c.shape[1] for c in trial_dat]) # fewest cells
     # trial_dat = np.concatenate([a[:, :fewest, :shortest] for a in trial_dat])
@@ -151,17 +384,48 @@ def posthoc_dff_and_coords(cm_obj):
     cm_obj.estimates.detrend_df_f()
     dff = cm_obj.estimates.F_dff
     
-    coords = cm.utils.visualization.get_contours(cm_obj.estimates.A, dims=cm_obj.dims)
+    coords = get_contours_cached(cm_obj.estimates.A, cm_obj.dims)
     
     return dff, coords
 
-def extract_cell_locs(cm_obj):
+_contour_cache = OrderedDict()
+
+def _footprint_key(A, dims, kwargs):
+    """Hashes the spatial footprints so contours can be reused when A hasn't changed."""
+    A = scipy.sparse.csc_matrix(A)
+    h = hashlib.sha1()
+    for arr in (A.indptr, A.indices, A.data):
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return (h.hexdigest(), A.shape, tuple(dims), tuple(sorted(kwargs.items())))
+
+def get_contours_cached(A, dims, max_cached=16, **kwargs):
+    """
+    Same as cm.utils.visualization.get_contours, but keeps the results for the last few sets of
+    footprints so the (slow) contour tracing only happens once per A. Kwargs are passed to
+    get_contours.
+    """
+    key = _footprint_key(A, dims, kwargs)
+    if key in _contour_cache:
+        _contour_cache.move_to_end(key)
+        return _contour_cache[key]
+    
+    coords = cm.utils.visualization.get_contours(A, dims=dims, **kwargs)
+    _contour_cache[key] = coords
+    if len(_contour_cache) > max_cached:
+        _contour_cache.popitem(last=False)
+    return coords
+
+def extract_cell_locs(cm_obj, contours=False):
     """
-    Get the neuron ID, center-of-mass, and coordinates(countors) of all cells from a caiman object. 
-    Loads directly from caiman obj or from a string/path and loads the caiman obj.
+    Get the neuron ID and center-of-mass, and optionally coordinates(countors), of all cells from
+    a caiman object. Loads directly from caiman obj or from a string/path and loads the caiman obj.
+    Centers of mass for every cell come from one sparse product of A against the pixel
+    coordinates (cm.base.rois.com), the contours are only traced if asked for.
 
     Args:
         cm_obj ([caiman, str]): caiman object or path to caiman object
+        contours (bool, optional): also get the full contours (cached per footprint). Defaults
+                                   to False.
 
     Returns:
         pd.DataFrame of data
@@ -170,12 +434,27 @@ def extract_cell_locs(cm_obj):
     if isinstance(cm_obj, str):
         cm_obj = load_as_obj(cm_obj)
         
-    cell_coords = cm.utils.visualization.get_contours(cm_obj.estimates.A, dims=cm_obj.dims)
-    df = pd.DataFrame(cell_coords)
+    return cell_locs_from_A(cm_obj.estimates.A, cm_obj.dims, contours=contours)
+
+def cell_locs_from_A(A, dims, contours=False):
+    """
+    Same as extract_cell_locs, but straight from spatial footprints A (pixels x cells) and the
+    plane dims, eg. for seeds that haven't been fit yet.
+    """
+    A = scipy.sparse.csc_matrix(A, dtype=np.float64)
+    if contours:
+        df = pd.DataFrame(get_contours_cached(A, dims))
+        com = np.array(df['CoM'].tolist())
+    else:
+        com = cm.base.rois.com(A, *dims)
+        df = pd.DataFrame({
+            'neuron_id': np.arange(1, com.shape[0]+1),
+            'CoM': list(com),
+        })
     
-     # x and y are flipped here bc rows x cols
-    df = pd.concat([df, df.loc[:, 'CoM'].agg(lambda x: x[0]).rename('y')], axis=1)
-    df = pd.concat([df, df.loc[:, 'CoM'].agg(lambda x: x[1]).rename('x')], axis=1)
+    # x and y are flipped here bc rows x cols
+    df['y'] = com[:, 0]
+    df['x'] = com[:, 1]
     
     return df
 
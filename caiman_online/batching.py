@@ -0,0 +1,166 @@
+"""
+Picks how many tiffs go into each batch. Starts from the declared image size and a minimum number
+of frames, then adjusts from how much memory and time the previous batches actually took, so a
+batch stays inside a memory budget and results come back within a target latency.
+"""
+
+import threading
+
+import psutil
+
+from .wscomm import WebSocketAlert
+
+
+class BatchSizer:
+    """
+    Adaptive batch sizer.
+
+    min_frames = frames per plane wanted in a batch for a decent fit, defaults to 500
+    max_frames = hard cap on frames per plane in a batch, defaults to None (no cap)
+    memory_budget = bytes a batch may use, defaults to half of the RAM available at start
+    target_latency = seconds from the first tiff of a batch being done to the fit being done,
+                     defaults to None (no latency limit)
+    overhead = guess at how many copies of the movie caiman holds while fitting, used until
+               there are real measurements
+    smoothing = weight of each new measurement in the running estimates (0-1)
+    """
+    def __init__(self, min_frames=500, max_frames=None, memory_budget=None, target_latency=None,
+                 overhead=4.0, smoothing=0.5):
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        if memory_budget is None:
+            memory_budget = psutil.virtual_memory().available // 2
+        self.memory_budget = memory_budget
+        self.target_latency = target_latency
+        self.overhead = overhead
+        self.smoothing = smoothing
+
+        self.frames_per_tiff = None
+        self.pixels = None
+        self.fr = None
+
+        self.bytes_per_frame = None
+        self.min_bytes_per_frame = None
+        self.secs_per_frame = None
+        self.batches_seen = 0
+
+    def configure(self, frames_per_tiff, dims, fr=None):
+        """
+        Sets the declared acquisition dimensions, eg. from the SI setup message.
+
+        Args:
+            frames_per_tiff (int): frames per plane in each tiff
+            dims (tuple): (y, x) size of each plane after cropping
+            fr (float, optional): frame rate per plane, lets acquisition time count toward latency
+        """
+        self.frames_per_tiff = int(frames_per_tiff)
+        self.pixels = int(dims[0]) * int(dims[1])
+        self.fr = fr
+        # float32 movie, times however many copies caiman makes. Measurements can only raise this,
+        # a fit that happens to free most of what it used shouldn't let batches outgrow the budget
+        self.min_bytes_per_frame = self.pixels * 4 * self.overhead
+        if self.bytes_per_frame is None:
+            self.bytes_per_frame = self.min_bytes_per_frame
+
+    def _smooth(self, old, new):
+        if old is None:
+            return new
+        return (1 - self.smoothing) * old + self.smoothing * new
+
+    def observe(self, frames, fit_time, mem_used=None):
+        """
+        Updates the estimates from a finished batch.
+
+        Args:
+            frames (int): frames per plane in the batch
+            fit_time (float): seconds the batch took to fit (all planes)
+            mem_used (int, optional): peak bytes the fit used (see PeakMemory), if it was measured
+        """
+        if frames <= 0:
+            return
+        self.secs_per_frame = self._smooth(self.secs_per_frame, fit_time / frames)
+        if mem_used is not None and mem_used > 0:
+            self.bytes_per_frame = self._smooth(self.bytes_per_frame, mem_used / frames)
+            if self.min_bytes_per_frame is not None:
+                self.bytes_per_frame = max(self.bytes_per_frame, self.min_bytes_per_frame)
+        self.batches_seen += 1
+
+    def frame_limits(self):
+        """
+        Most frames per plane allowed by memory and by latency.
+
+        Returns:
+            dict of limit name -> frames (None if there's nothing to go off of yet)
+        """
+        limits = {'memory': None, 'latency': None}
+        if self.bytes_per_frame:
+            limits['memory'] = int(self.memory_budget // self.bytes_per_frame)
+        if self.target_latency is not None and self.secs_per_frame:
+            secs = self.secs_per_frame + (1 / self.fr if self.fr else 0)
+            limits['latency'] = int(self.target_latency // secs)
+        return limits
+
+    def frames_per_batch(self):
+        """Frames per plane the next batch should have."""
+        frames = self.min_frames
+        limits = self.frame_limits()
+
+        if limits['latency'] is not None:
+            # grow when there's room, shrink when fits are too slow
+            frames = limits['latency']
+        if self.max_frames is not None:
+            frames = min(frames, self.max_frames)
+        if limits['memory'] is not None and frames > limits['memory']:
+            WebSocketAlert(f'Batch limited to {limits["memory"]} frames by memory budget.', 'warn')
+            frames = limits['memory']
+
+        return max(frames, self.frames_per_tiff or 1)
+
+    def tiffs_per_batch(self):
+        """Number of tiffs the next batch should have, at least 1."""
+        if self.frames_per_tiff is None:
+            raise ValueError('Call configure() before asking for a batch size.')
+        return max(1, self.frames_per_batch() // self.frames_per_tiff)
+
+
+def process_memory():
+    """Resident memory of this process in bytes."""
+    return psutil.Process().memory_info().rss
+
+
+class PeakMemory:
+    """
+    Measures the most memory this process used while in a with block, above what it was using at
+    the start. Polls the resident memory on a thread, since what's still held after a fit is usually
+    much less than what the fit needed at its peak.
+
+    interval = seconds between samples
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, process_memory())
+
+    def __enter__(self):
+        self.start = self.peak = process_memory()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll, name='PeakMemory', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_memory())
+        return False
+
+    @property
+    def used(self):
+        """Peak bytes above the starting point."""
+        return self.peak - self.start
@@ -0,0 +1,103 @@
+"""
+Crash-safe checkpoints for an online session. Everything needed to pick a session back up (counters,
+trial data, every batch's traces, registration templates, batch sizing) is appended to one binary
+log as it happens. Each record is length-prefixed and checksummed, so a crash mid-write only ever
+loses the last, partial record, which is dropped on the next read.
+"""
+
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+MAGIC = b'CKP1'
+_HEADER = struct.Struct('<4sII') # magic, payload length, crc32 of payload
+
+
+def compact_batch(batch_data):
+    """
+    Copies a batch's per-plane json data with the traces as float32 (or smaller, if that's what
+    they already are) arrays for checkpointing.
+    """
+    compact = []
+    for plane_data in batch_data:
+        plane_data = dict(plane_data)
+        for key in ('c', 'dff'):
+            if key in plane_data:
+                arr = np.asarray(plane_data[key])
+                if arr.dtype.itemsize > 4 or arr.dtype.kind != 'f':
+                    arr = arr.astype(np.float32)
+                plane_data[key] = arr
+        compact.append(plane_data)
+    return compact
+
+
+class CheckpointLog:
+    """
+    Append-only log of (kind, payload) records.
+
+    path = file to write to
+    fresh = start a new log, throwing away whatever was in the file. Otherwise new records are added
+            after the existing ones (for resuming).
+    """
+    def __init__(self, path, fresh=True):
+        self.path = path
+        self._lock = threading.Lock()
+        if fresh or not os.path.exists(path):
+            open(path, 'wb').close()
+        else:
+            # drop a partial record left by a crash so new records follow a valid one
+            _, valid_length = self._scan()
+            with open(path, 'r+b') as f:
+                f.truncate(valid_length)
+
+    def append(self, kind, payload):
+        """Writes one record and syncs it to disk before returning."""
+        data = pickle.dumps((kind, payload), protocol=pickle.HIGHEST_PROTOCOL)
+        header = _HEADER.pack(MAGIC, len(data), zlib.crc32(data))
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                f.write(header + data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _scan(self):
+        records = []
+        valid_length = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                magic, length, crc = _HEADER.unpack(header)
+                data = f.read(length)
+                if magic != MAGIC or len(data) < length or zlib.crc32(data) != crc:
+                    break
+                records.append(pickle.loads(data))
+                valid_length = f.tell()
+        return records, valid_length
+
+    def records(self):
+        """All complete records in the log, in the order they were written."""
+        with self._lock:
+            return self._scan()[0]
+
+    def replay(self):
+        """
+        Folds the log into the latest session state.
+
+        Returns:
+            dict with 'messages' (json messages from SI/DAQ, in order), 'batches' (list of compact
+            batch data) and 'state' (counters etc. as of the last batch)
+        """
+        session = {'messages': [], 'batches': [], 'state': {}}
+        for kind, payload in self.records():
+            if kind == 'message':
+                session['messages'].append(payload)
+            elif kind == 'batch':
+                session['batches'].append(payload['data'])
+                session['state'] = payload['state']
+        return session
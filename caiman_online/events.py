@@ -0,0 +1,140 @@
+"""
+Trial data from the DAQ, stored by trial number so each batch can look up exactly the trials that
+are in its tiffs. Columns are numpy arrays that grow by doubling, so appending a trial is O(1) and
+getting a batch's trials is one fancy index. Stim times can be a different length every trial and
+are kept flat with offsets.
+"""
+
+import threading
+
+import numpy as np
+
+
+class _Column:
+    """A growable 1D array."""
+    def __init__(self, dtype, fill, capacity=64):
+        self.fill = fill
+        self.data = np.full(capacity, fill, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == self.data.size:
+            grown = np.full(self.data.size * 2, self.fill, dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        while self.size + values.size > self.data.size:
+            grown = np.full(self.data.size * 2, self.fill, dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:self.size + values.size] = values
+        self.size += values.size
+
+    @property
+    def values(self):
+        return self.data[:self.size]
+
+
+class TrialEventStore:
+    """
+    Per-trial DAQ data (condition, visual condition and stim times) keyed by trial number. Trial
+    numbers are acquisition numbers counted from 0, so trial i goes with the i-th tiff of the
+    session. Safe to append from one thread while another reads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trial = _Column(np.int64, -1)
+        self._cond = _Column(np.float64, np.nan)
+        self._vis_cond = _Column(np.float64, np.nan)
+        self._offsets = _Column(np.int64, 0)
+        self._offsets.append(0)
+        self._stim_times = _Column(np.float64, np.nan)
+        self._scalar = _Column(bool, False)
+        self._rows = {} # trial number -> row
+
+    def __len__(self):
+        return self._trial.size
+
+    def __contains__(self, trial):
+        return trial in self._rows
+
+    def append(self, condition, stim_times, vis_cond, trial=None):
+        """
+        Adds a trial.
+
+        Args:
+            condition (float): stim condition
+            stim_times (float or list): stim time(s) in the trial
+            vis_cond (float): visual condition
+            trial (int, optional): trial number. Defaults to the next one after the last trial.
+        """
+        times = np.asarray(stim_times, dtype=np.float64)
+        with self._lock:
+            if trial is None:
+                trial = int(self._trial.values[-1]) + 1 if self._trial.size else 0
+            self._rows[trial] = self._trial.size
+            self._trial.append(trial)
+            self._cond.append(np.nan if condition is None else condition)
+            self._vis_cond.append(np.nan if vis_cond is None else vis_cond)
+            self._scalar.append(times.ndim == 0)
+            self._stim_times.extend(times.ravel())
+            self._offsets.append(self._stim_times.size)
+
+    def rows(self, trials):
+        """Rows of the given trial numbers, -1 for trials with no data yet."""
+        with self._lock:
+            return np.array([self._rows.get(int(t), -1) for t in trials], dtype=np.int64)
+
+    def take(self, trials):
+        """
+        Gets the data for a list of trials, eg. the trials in one batch, in that order. Trials
+        without data yet get NaN conditions and no stim times.
+
+        Returns:
+            dict with 'condition', 'vis_cond' (arrays) and 'stim_times' (list, one entry per trial)
+        """
+        rows = self.rows(trials)
+        found = rows >= 0
+        with self._lock:
+            cond = np.full(rows.size, np.nan)
+            vis_cond = np.full(rows.size, np.nan)
+            cond[found] = self._cond.values[rows[found]]
+            vis_cond[found] = self._vis_cond.values[rows[found]]
+            offsets = self._offsets.values
+            flat = self._stim_times.values
+            scalar = self._scalar.values
+            stim_times = []
+            for row in rows:
+                if row < 0:
+                    stim_times.append([])
+                elif scalar[row]:
+                    stim_times.append(float(flat[offsets[row]]))
+                else:
+                    stim_times.append(flat[offsets[row]:offsets[row + 1]].tolist())
+        return {'condition': cond, 'vis_cond': vis_cond, 'stim_times': stim_times}
+
+    def trial_range(self, start, stop):
+        """Same as take, for trials start to stop-1."""
+        return self.take(range(start, stop))
+
+    @property
+    def trials(self):
+        return self._trial.values.copy()
+
+    # whole-session lists in the order trials arrived, for the .mat exports
+
+    @property
+    def conditions(self):
+        return self._cond.values.tolist()
+
+    @property
+    def vis_conds(self):
+        return self._vis_cond.values.tolist()
+
+    @property
+    def stim_times(self):
+        return self.take(self._trial.values)['stim_times']
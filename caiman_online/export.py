@@ -0,0 +1,356 @@
+"""
+Writing results to disk. Whole-file writes go to a temp file next to the target and get renamed
+into place, so a reader (or a crash) never sees a half-written file. ResultWriter runs the writes on
+its own thread so the websocket loop never waits on the disk (or a slow network share), and
+IncrementalMatExporter grows the session .mat files batch by batch.
+"""
+
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+import h5py
+import numpy as np
+import scipy.io as sio
+
+from .analysis import process_data, sidecar_path, stim_align_trialwise
+from .timing import align_planes
+from .wscomm import WebSocketAlert
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def atomic_write(path, write_func, mode='w'):
+    """
+    Writes a file by handing an open temp file to write_func, then renaming it to path.
+
+    Args:
+        path (str): final location of the file
+        write_func (function): called with the open file object, does the actual writing
+        mode (str, optional): mode to open the temp file with. Defaults to 'w'.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write_func(f)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _json_default(obj):
+    """Lets numpy arrays/scalars (eg. float32 traces) go into JSON."""
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == np.float16:
+            obj = obj.astype(np.float32)
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def save_json_atomic(path, data):
+    """Dumps data to a JSON file at path. Uses orjson if it's installed (much faster with arrays)."""
+    if orjson is not None:
+        # orjson writes float32 arrays with the shortest float32 repr, so the files shrink too
+        content = orjson.dumps(data, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+        atomic_write(path, lambda f: f.write(content), mode='wb')
+    else:
+        atomic_write(path, lambda f: json.dump(data, f, default=_json_default))
+
+
+def savez_atomic(path, **arrays):
+    """Saves arrays to a .npz file at path (see np.savez)."""
+    atomic_write(path, lambda f: np.savez(f, **arrays), mode='wb')
+
+
+def save_result(path, data, sidecar=True, dtype=np.float32):
+    """
+    Saves a result dict (see OnlineAnalysis.json) to a JSON file at path, and optionally the
+    traces and splits to a binary .npz sidecar next to it for fast loading (see analysis.load_result).
+    Traces in the sidecar are saved as dtype.
+    """
+    save_json_atomic(path, data)
+    if sidecar:
+        savez_atomic(
+            sidecar_path(path),
+            c=np.asarray(data['c'], dtype=dtype),
+            dff=np.asarray(data['dff'], dtype=dtype),
+            splits=np.asarray(data['splits']),
+        )
+
+
+def savemat_atomic(path, data):
+    """Saves a dict of data to a .mat file at path (see scipy.io.savemat)."""
+    atomic_write(path, lambda f: sio.savemat(f, data), mode='wb')
+
+
+class ResultWriter:
+    """
+    Runs writes in order on a single background thread. submit() returns right away with a
+    concurrent.futures.Future, which can be awaited from asyncio with asyncio.wrap_future.
+    """
+    def __init__(self, name='result-writer'):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._closed = False
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                future, func, args, kwargs = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    WebSocketAlert(f'Problem writing results in {func.__name__}: {e}', 'error')
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs) to run on the writer thread.
+
+        Returns:
+            concurrent.futures.Future: resolves to the return value of func
+        """
+        if self._closed:
+            raise RuntimeError('ResultWriter is closed.')
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def flush(self):
+        """Blocks until everything submitted so far has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Writes anything still queued and stops the thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _mat73_header():
+    """The 512 byte userblock MATLAB expects at the start of a v7.3 (HDF5) .mat file."""
+    text = (f'MATLAB 7.3 MAT-file, Platform: {sys.platform}, '
+            f'Created on: {time.strftime("%a %b %d %H:%M:%S %Y")} HDF5 schema 1.00 .')
+    header = text.ljust(116).encode('ascii') + b'\x00' * 8 + b'\x00\x02' + b'IM'
+    return header.ljust(512, b'\x00')
+
+
+class MatH5File:
+    """
+    A MATLAB v7.3 compatible .mat file (HDF5 underneath) with datasets that can be grown as data
+    comes in. Arrays are given in the usual numpy order and stored transposed, so MATLAB sees the
+    same shape, eg. a cells x time array here is cells x time in MATLAB too.
+
+    path = where to make the file (overwrites)
+    dtype = float64 (MATLAB double) or float32 (single), defaults to float64
+    compression = HDF5 filter for the datasets (eg. 'gzip', which MATLAB can read), defaults to None
+    """
+    def __init__(self, path, dtype=np.float64, compression=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError('MATLAB files can only hold float32 (single) or float64 (double).')
+        self.compression = compression
+        with h5py.File(path, 'w', userblock_size=512):
+            pass
+        with open(path, 'r+b') as f:
+            f.write(_mat73_header())
+        self.file = h5py.File(path, 'a')
+
+    def __contains__(self, name):
+        return name in self.file
+
+    def __getitem__(self, name):
+        return self.file[name]
+
+    def _mark(self, dset):
+        matlab_class = 'single' if dset.dtype == np.float32 else 'double'
+        dset.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+
+    def _create(self, name, data, **kwargs):
+        if self.compression is not None and data.size > 0:
+            kwargs.update(compression=self.compression, shuffle=True)
+        dset = self.file.create_dataset(name, data=data, **kwargs)
+        self._mark(dset)
+        return dset
+
+    def write(self, name, data, dtype=None):
+        """Writes (or overwrites) a fixed size array, as the file's dtype unless dtype is given."""
+        data = np.asarray(data, dtype=dtype or self.dtype)
+        if name in self.file:
+            del self.file[name]
+        self._create(name, data.T)
+
+    def append(self, name, data, axis):
+        """
+        Appends data to a dataset along axis, making it if needed. All other axes are trimmed to
+        the smaller of the existing dataset and the new data.
+
+        Args:
+            name (str): dataset (MATLAB variable) name
+            data (array-like): data to add, in numpy order
+            axis (int): axis (in numpy order) to grow along
+        """
+        data = np.asarray(data, dtype=self.dtype).T
+        h5_axis = data.ndim - 1 - axis
+
+        if name not in self.file:
+            self._create(name, data, maxshape=(None,) * data.ndim, chunks=True)
+            return
+
+        dset = self.file[name]
+        for ax in range(data.ndim):
+            if ax == h5_axis:
+                continue
+            size = min(dset.shape[ax], data.shape[ax])
+            if size < dset.shape[ax]:
+                dset.resize(size, axis=ax)
+            if size < data.shape[ax]:
+                data = np.take(data, np.arange(size), axis=ax)
+
+        start = dset.shape[h5_axis]
+        dset.resize(start + data.shape[h5_axis], axis=h5_axis)
+        index = [slice(None)] * data.ndim
+        index[h5_axis] = slice(start, None)
+        dset[tuple(index)] = data
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def _as_matrix(data):
+    """Makes a (possibly ragged) list of lists into a NaN-padded float array for MATLAB."""
+    try:
+        return np.array(data, dtype=np.float64)
+    except ValueError:
+        rows = [np.atleast_1d(np.asarray(r, dtype=np.float64)) for r in data]
+        out = np.full((len(rows), max(r.size for r in rows)), np.nan)
+        for i, r in enumerate(rows):
+            out[i, :r.size] = r
+        return out
+
+
+class IncrementalMatExporter:
+    """
+    Writes traces and PSTHs to .mat files batch by batch as fits finish, so by the end of the
+    session there's nothing left to do but add the trial data and flush. Makes the same files as
+    SISocketServer.save_trial_data_mat. Note that PSTHs are normalized per batch here, not over
+    the whole session. Not thread safe, do all calls from one thread (eg. the ResultWriter).
+
+    folder = where to save the .mat files
+    dtype = float32 (default) or float64 for the traces and PSTHs
+    compression = HDF5 compression for them (eg. 'gzip'), defaults to None
+    """
+    def __init__(self, folder, dtype=np.float32, compression=None):
+        self.folder = folder
+        self.traces_file = MatH5File(os.path.join(folder, 'caiman_traces_full.mat'), dtype=dtype,
+                                     compression=compression)
+        self.psths_file = MatH5File(os.path.join(folder, 'caiman_psths.mat'), dtype=dtype,
+                                    compression=compression)
+        self.trace_min = None
+        self.batches = 0
+
+    def append_batch(self, batch_data):
+        """
+        Adds a finished batch to the files and flushes them to disk.
+
+        Args:
+            batch_data (list): json data for each plane of the batch (OnlineAnalysis.data_this_round)
+        """
+        splits = np.array(batch_data[0]['splits'])
+        if all(plane.get('frame_times') is not None for plane in batch_data):
+            # every plane on plane 0's frame times, trials cut by time
+            fit_data, frame_times = align_planes([plane['c'] for plane in batch_data],
+                                                 [plane['frame_times'] for plane in batch_data])
+            trial_kwargs = dict(trial_mode='time', frame_times=frame_times)
+        else:
+            fewest_frames = min([np.asarray(plane['c']).shape[1] for plane in batch_data])
+            fit_data = np.concatenate([np.asarray(plane['c'])[:, :fewest_frames] for plane in batch_data])
+            trial_kwargs = {}
+
+        if self.trace_min is not None and self.trace_min.size != fit_data.shape[0]:
+            WebSocketAlert('Number of cells changed between batches! Trimming to fewest.', 'error')
+            ncells = min(self.trace_min.size, fit_data.shape[0])
+            self.trace_min = self.trace_min[:ncells]
+            fit_data = fit_data[:ncells]
+
+        batch_min = fit_data.min(axis=1)
+        self.trace_min = batch_min if self.trace_min is None else np.minimum(self.trace_min, batch_min)
+
+        # raw traces, min subtracted over the whole session in finalize
+        self.traces_file.append('tracesCaiman', fit_data, axis=1)
+        self.psths_file.append('psthsCaiman', process_data(fit_data, splits, **trial_kwargs), axis=0)
+
+        self.traces_file.flush()
+        self.psths_file.flush()
+        self.batches += 1
+
+    def _subtract_min(self, chunk_size=10000):
+        """Subtracts each cell's session-wide min from tracesCaiman, a chunk of frames at a time."""
+        dset = self.traces_file['tracesCaiman']  # stored as time x cells
+        for start in range(0, dset.shape[0], chunk_size):
+            stop = min(start + chunk_size, dset.shape[0])
+            dset[start:stop] = dset[start:stop] - self.trace_min[:dset.shape[1]]
+
+    def finalize(self, stim_times, stim_conds, vis_conds, has_daq_data=False):
+        """
+        Adds the trial data, finishes the traces, saves stim-aligned PSTHs if there is DAQ data, and
+        closes the files.
+        """
+        if self.batches == 0:
+            WebSocketAlert('No batches were exported.', 'warn')
+        else:
+            self._subtract_min()
+
+        trial_data = {
+            'stimTimesCaiman': stim_times,
+            'stimCondsCaiman': stim_conds,
+            'visCondsCaiman': vis_conds,
+        }
+        for f in (self.traces_file, self.psths_file):
+            for name, data in trial_data.items():
+                if len(data) > 0:
+                    # trial data stays double, stim times need the precision
+                    f.write(name, _as_matrix(data), dtype=np.float64)
+
+        if has_daq_data and self.batches > 0:
+            psths = self.psths_file['psthsCaiman'][()].T
+            out = {
+                'psthsAlignedCaiman': stim_align_trialwise(psths, stim_times),
+                'stimCondsCaiman': stim_conds,
+                'visCondsCaiman': vis_conds
+            }
+            savemat_atomic(os.path.join(self.folder, 'caiman_psths_aligned.mat'), out)
+
+        self.close()
+
+    def close(self):
+        self.traces_file.close()
+        self.psths_file.close()
@@ -0,0 +1,147 @@
+"""
+Out-of-core final fit over a whole session. Instead of joining every batch into one memmap and
+fitting it all at once, the spatial components (A and background b) are fit once on a subsample of
+frames taken from across the session, then every batch memmap is projected onto them and
+deconvolved on its own, in parallel on the worker pool. Only traces (cells x time) are ever held
+for the full session, never the movie.
+"""
+
+import warnings
+
+import numpy as np
+import scipy.sparse
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', category=FutureWarning)
+    import caiman as cm
+    from caiman.source_extraction.cnmf import cnmf as cnmf
+    from caiman.source_extraction.cnmf.deconvolution import constrained_foopsi
+
+from .utils import tic, toc
+from .workers import get_pool
+
+
+def memmap_frames(memmap):
+    """Number of frames in a caiman memmap, from its file name."""
+    return int(memmap.split('_')[-2])
+
+
+def subsample_movie(memmaps, n_frames=3000):
+    """
+    Builds a T x H x W movie for fitting the spatial components, made of one contiguous block of
+    frames from each memmap so the whole session is represented but the temporal structure in each
+    block is kept.
+
+    Args:
+        memmaps (list): memmap files for one plane, in order
+        n_frames (int, optional): total frames to take. Defaults to 3000.
+
+    Returns:
+        T x H x W float32 movie
+    """
+    per_map = max(1, n_frames // len(memmaps))
+    blocks = []
+    for memmap in memmaps:
+        Yr, dims, T = cm.load_memmap(memmap)
+        start = max(0, (T - per_map) // 2)
+        stop = min(T, start + per_map)
+        block = np.asarray(Yr[:, start:stop], dtype=np.float32)
+        blocks.append(np.reshape(block.T, [stop - start] + list(dims), order='F'))
+    return np.concatenate(blocks)
+
+
+def chunk_ranges(memmaps, chunk_frames=None):
+    """
+    Splits each memmap into (memmap, start, stop) chunks of at most chunk_frames frames. Chunks
+    never cross memmaps. Defaults to one chunk per memmap.
+    """
+    chunks = []
+    for memmap in memmaps:
+        T = memmap_frames(memmap)
+        step = chunk_frames or T
+        chunks.extend((memmap, start, min(start + step, T)) for start in range(0, T, step))
+    return chunks
+
+
+def _fit_chunk(args):
+    """
+    Traces for one chunk of frames. Solves for the activity of the cells and background together
+    by least squares against the shared footprints, then deconvolves each cell using the AR
+    coefficients from the spatial fit.
+
+    Returns:
+        C (denoised), C_raw, f (background), S (spikes) for the chunk
+    """
+    memmap, start, stop, AB, gram_inv, n_cells, g, p = args
+    Yr, dims, T = cm.load_memmap(memmap)
+    Y = np.asarray(Yr[:, start:stop], dtype=np.float32)
+
+    traces = gram_inv @ np.asarray(AB.T @ Y)
+    C_raw = traces[:n_cells]
+    f = traces[n_cells:]
+
+    if not p:
+        return C_raw, C_raw, f, np.zeros_like(C_raw)
+
+    C = np.zeros_like(C_raw)
+    S = np.zeros_like(C_raw)
+    for i, trace in enumerate(C_raw):
+        g_i = None if g is None else g[i]
+        c, _, _, _, _, sp, _ = constrained_foopsi(trace.astype(np.float64), g=g_i, p=p)
+        C[i] = c
+        S[i] = sp
+    return C, C_raw, f, S
+
+
+def fit_chunked(memmaps, Ain, opts, n_processes, dview=None, subsample_frames=3000,
+                chunk_frames=None):
+    """
+    Fits a whole plane's session out of core.
+
+    Args:
+        memmaps (list): memmap files for the plane, one per batch, in order
+        Ain (array): seeded footprints
+        opts (CNMFParams): caiman params
+        n_processes (int): for the spatial CNMF fit
+        dview (optional): for the spatial CNMF fit. Defaults to None.
+        subsample_frames (int, optional): frames used to fit A. Defaults to 3000.
+        chunk_frames (int, optional): max frames per temporal chunk. Defaults to None (one chunk
+                                      per batch memmap).
+
+    Returns:
+        CNMF object with A/b from the subsample fit and C/f/YrA/S for every frame of the session
+    """
+    t = tic()
+    print(f'Fitting spatial components on {subsample_frames} frames from {len(memmaps)} batches...')
+    cnm = cnmf.CNMF(n_processes, params=opts, dview=dview, Ain=Ain)
+    cnm.fit(subsample_movie(memmaps, subsample_frames))
+    est = cnm.estimates
+    print(f'Spatial fit done. Took {toc(t):.4f}s')
+
+    # cells and background solved together, the gram matrix is tiny so invert it once here
+    A = scipy.sparse.csc_matrix(est.A, dtype=np.float32)
+    n_cells = A.shape[1]
+    if est.b is not None and np.size(est.b) > 0:
+        AB = scipy.sparse.hstack([A, scipy.sparse.csc_matrix(est.b, dtype=np.float32)], format='csc')
+    else:
+        AB = A
+    gram = (AB.T @ AB).toarray()
+    gram_inv = np.linalg.pinv(gram).astype(np.float32)
+
+    g = None if est.g is None else list(est.g)
+    p = opts.preprocess['p']
+
+    t = tic()
+    chunks = chunk_ranges(memmaps, chunk_frames)
+    print(f'Extracting traces from {len(chunks)} chunks...')
+    results = get_pool().ensure().map(
+        _fit_chunk, [(m, start, stop, AB, gram_inv, n_cells, g, p) for m, start, stop in chunks])
+    print(f'Trace extraction done. Took {toc(t):.4f}s')
+
+    C, C_raw, f, S = (np.concatenate(r, axis=1) for r in zip(*results))
+    est.C = C
+    est.YrA = C_raw - C
+    est.f = f if f.shape[0] else None
+    est.S = S
+    est.F_dff = None
+    return cnm
@@ -0,0 +1,211 @@
+"""
+Cleans up the files the pipeline makes. Every memmap and output is recorded in a manifest when it's
+written, so cleanup only ever touches files we made (no globbing) and can pick up where the last
+session left off. Deletes run on a background thread, wait until nothing has a file memory mapped,
+and are retried later if the OS still won't let go of the file. Optionally keeps scratch memmaps
+under a disk quota by deleting the oldest ones.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+import weakref
+from collections import Counter
+
+from .export import save_json_atomic
+from .wscomm import WebSocketAlert
+
+
+class Janitor:
+    """
+    Tracks and deletes files made by the pipeline.
+
+    manifest_path = json file listing the tracked files, kept up to date as files are tracked/deleted
+    quota = max bytes of 'mmap' files to keep around, oldest go first. Files that are protected (eg. the
+            current session's memmaps, which the final fit needs) are never deleted for it.
+            Defaults to None (no limit).
+    retry_interval = seconds between tries at files that couldn't be deleted yet
+    """
+    def __init__(self, manifest_path, quota=None, retry_interval=5.0):
+        self.manifest_path = manifest_path
+        self.quota = quota
+        self.retry_interval = retry_interval
+
+        self.manifest = {} # path -> {'kind', 'size', 'created'}
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f:
+                    self.manifest = json.load(f)
+            except ValueError:
+                WebSocketAlert(f'Cleanup manifest {manifest_path} is corrupt, starting a new one.', 'warn')
+
+        self.handles = Counter() # path -> number of live memmaps of it
+        self.pending = set()
+        self.protected = set() # paths the quota won't delete
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='Janitor', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _save_manifest(self):
+        save_json_atomic(self.manifest_path, self.manifest)
+
+    def track(self, path, kind='output', protect=False):
+        """
+        Records a file the pipeline made so it can be cleaned up later.
+
+        Args:
+            path (str): the file
+            kind (str, optional): what it is, eg. 'mmap', 'hdf5', 'output'. Defaults to 'output'.
+            protect (bool, optional): keep it out of the quota (see protect). Defaults to False.
+        """
+        path = os.path.abspath(path)
+        if protect:
+            self.protect([path])
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        with self._lock:
+            self.manifest[path] = {'kind': kind, 'size': size, 'created': time.time()}
+            self.pending.discard(path)
+            self._save_manifest()
+            if kind == 'mmap':
+                self._enforce_quota()
+
+    def reserve(self, paths):
+        """
+        Takes files off the pending deletes because they're about to be written again (eg. the same
+        output name in a new session). Call it before the write, so a delete that's still being
+        retried can't remove the new file.
+        """
+        with self._lock:
+            self.pending.difference_update(os.path.abspath(p) for p in paths)
+
+    def reserve_prefix(self, prefix):
+        """Same as reserve, for every pending file whose name starts with prefix (for when the full
+        name isn't known until it's written, like caiman's memmaps)."""
+        prefix = os.path.abspath(prefix)
+        with self._lock:
+            self.pending = {p for p in self.pending if not p.startswith(prefix)}
+
+    def protect(self, paths):
+        """Keeps files from being deleted to stay under the quota, until they're released."""
+        with self._lock:
+            self.protected.update(os.path.abspath(p) for p in paths)
+
+    def release(self, paths=None):
+        """Lets the quota delete protected files again (all of them if paths isn't given)."""
+        with self._lock:
+            if paths is None:
+                self.protected.clear()
+            else:
+                self.protected.difference_update(os.path.abspath(p) for p in paths)
+
+    def watch(self, path, obj):
+        """
+        Holds off deleting path until obj (eg. a memmap of it, or anything that keeps one alive) has
+        been garbage collected.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self.handles[path] += 1
+        weakref.finalize(obj, self._handle_closed, path)
+
+    def _handle_closed(self, path):
+        with self._lock:
+            self.handles[path] -= 1
+            if self.handles[path] <= 0:
+                del self.handles[path]
+        self._wake.set()
+
+    def delete(self, paths):
+        """Queues files to be deleted in the background. Deleting a protected file releases it."""
+        paths = [os.path.abspath(p) for p in paths]
+        with self._lock:
+            self.pending.update(paths)
+            self.protected.difference_update(paths)
+        self._wake.set()
+
+    def delete_kind(self, *kinds):
+        """Queues every tracked file of the given kinds (all files if none given) to be deleted."""
+        with self._lock:
+            paths = [p for p, info in self.manifest.items() if not kinds or info['kind'] in kinds]
+        self.delete(paths)
+
+    def _enforce_quota(self):
+        if self.quota is None:
+            return
+        scratch = sorted((info['created'], p, info['size']) for p, info in self.manifest.items()
+                         if info['kind'] == 'mmap' and p not in self.pending)
+        # protected files count towards the total but are never deleted for it
+        total = sum(size for _, _, size in scratch)
+        to_delete = []
+        for _, path, size in scratch:
+            if total <= self.quota:
+                break
+            if path in self.protected:
+                continue
+            to_delete.append(path)
+            total -= size
+        if to_delete:
+            WebSocketAlert(f'Scratch memmaps over quota, deleting the {len(to_delete)} oldest.', 'warn')
+            self.delete(to_delete)
+
+    def _sweep(self):
+        """One pass over the pending files. Returns True if anything is left to try again later."""
+        with self._lock:
+            todo = [p for p in self.pending if self.handles[p] <= 0]
+        done = False
+        for path in todo:
+            with self._lock:
+                # it may have been made again (and tracked) since the pass started
+                if path not in self.pending:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # still mapped or open somewhere (mostly on windows), try again later
+                    continue
+                self.pending.discard(path)
+                self.manifest.pop(path, None)
+                done = True
+        with self._lock:
+            if done:
+                self._save_manifest()
+            return bool(self.pending)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.retry_interval)
+            self._wake.clear()
+            self._sweep()
+
+    def flush(self, timeout=None):
+        """
+        Waits for the pending deletes, up to timeout seconds.
+
+        Returns:
+            bool: True if nothing is left pending
+        """
+        start = time.perf_counter()
+        while self._sweep():
+            if timeout is not None and time.perf_counter() - start > timeout:
+                return False
+            time.sleep(min(0.1, self.retry_interval))
+        return True
+
+    def close(self):
+        """Makes a last try at the pending deletes and stops the background thread."""
+        if self._stopped:
+            return
+        self._sweep()
+        self._stopped = True
+        self._wake.set()
+        atexit.unregister(self.close)
@@ -1,4 +1,3 @@
-import json
 import os
 from glob import glob
 import warnings
@@ -13,20 +12,32 @@ import matplotlib.pyplot as plt
 import numpy as np
 from ScanImageTiffReader import ScanImageTiffReader
 
-from .analysis import extract_cell_locs
+from .analysis import cell_locs_from_A, extract_cell_locs, sidecar_path
 from . import networking
-from .utils import cleanup, make_ain, ptoc, tic, toc
+from .export import save_result
+from .finalfit import fit_chunked
+from .janitor import Janitor
+from .metadata import read_metadata
+from .preview import PreviewProjector, preview_dff
+from .registration import make_template, memmap_name, open_memmap_movie, register_rigid
+from .timing import FrameIndex
+from .utils import make_ain, ptoc, tic, toc
+from .workers import get_pool
 
 
 class OnlineAnalysis:
     """
     The main class to implement caiman pseudo-online analysis.
     """
-    def __init__(self, caiman_params, channels, planes, x_start, x_end, folder, batch_size=15):
+    def __init__(self, caiman_params, channels, planes, x_start, x_end, folder, batch_size=15,
+                 preview=False, preview_opts=None, rigid_register=False, reg_opts=None,
+                 auto_configure=False, resume=False, scratch_quota=None, precision=np.float32):
         self.channels = channels
         self.planes = planes
         self.x_start = x_start
         self.x_end = x_end
+        self.janitor = None
+        self.scratch_quota = scratch_quota # max bytes of memmaps to keep, the current session's are never deleted for it
         self.folder = folder
         self.caiman_params = caiman_params
         
@@ -38,21 +49,65 @@ class OnlineAnalysis:
         self.opts = params.CNMFParams(params_dict=self.caiman_params)
         self.batch_size = batch_size # can be overridden by expt runner
         self.fnumber = 0
+        self.writer = None # optional export.ResultWriter, set by the server to write off-thread
+        self.sidecar = True # also save traces as .npz next to each json for fast loading
+        self.dtype = np.dtype(precision) # traces are kept and saved as this (float32/float16/float64)
         
+        # fast preview traces before each full fit, see do_preview
+        self.preview = preview
+        self.preview_opts = dict(neuropil=False, ssub=1, tsub=1)
+        if preview_opts is not None:
+            self.preview_opts.update(preview_opts)
+        self.on_preview = None # called with the previews for all planes and the batch number
+        self._projectors = {}
+        
+        # rigid registration while memory mapping, see make_registered_mmap
+        self.rigid_register = rigid_register
+        self.reg_opts = dict(max_shift=self.caiman_params.get('max_shifts'), upsample=1, n_threads=None)
+        if reg_opts is not None:
+            self.reg_opts.update(reg_opts)
+        self.reg_templates = {}
+        self._batch_splits = None
+        if self.rigid_register:
+            # frames come in registered, don't let caiman do it again
+            self.opts.change_params(dict(motion_correct=False))
+        elif self.preview:
+            warnings.warn('preview without rigid_register projects the raw (not motion corrected) frames.')
+        
+        # take channels/planes/fr from the tiff headers if no setup message comes from SI
+        self.auto_configure = auto_configure
+        self.configured = False
+        self.metadata = None
+        
+        # every batch's memmaps and splits, for the final fit
+        self.processed_tiffs = []
+        self.previous_tiffs = set() # tiffs from earlier sessions in the same folder, see new_session
+        self.tiff_numbers = {} # tiff -> acquisition number, given once when it first shows up
+        self.memmaps = []
+        self.session_splits = {} # plane -> splits
+        self.session_frame_times = {} # plane -> each batch's frame times (None if it had none)
+        self.session_trials = [] # trial numbers of every batch's tiffs, in the same order
+        
+        self.frame_index = None # timing of every frame in the current batch, see timing.py
         self._splits = None
         self._json = None
         self.times = None
         self.cond = None
         self.vis_cond = None
+        self.events = None # TrialEventStore with the DAQ's trial data, set by the server
+        self.batch_trials = [] # trial (acquisition) number of each tiff in the current batch
         
         # other init things to do
         # start server
         self._start_cluster()
-        # cleanup
-        cleanup(self.folder, 'mmap')
-        cleanup(self.save_folder, 'hdf5')
-        cleanup(self.save_folder, 'json')
-        cleanup(os.getcwd(), 'npz')
+        # cleanup, unless resuming a session that needs its outputs
+        if not resume:
+            self.clean_outputs()
+            
+            
+    def clean_outputs(self):
+        """Queues the memmaps and outputs from the previous session to be deleted in the background."""
+        self.janitor.delete_kind()
     
     
     ##----- properties, setters, getters ----##
@@ -67,6 +122,12 @@ class OnlineAnalysis:
         self.folder_tiffs = folder + '*.tif*'
         self.save_folder = folder + 'out/'
         self._verify_folder_structure()
+        # files made in this folder are tracked in its own manifest
+        manifest = folder + 'caiman_manifest.json'
+        if self.janitor is None or self.janitor.manifest_path != manifest:
+            if self.janitor is not None:
+                self.janitor.close()
+            self.janitor = Janitor(manifest, quota=self.scratch_quota)
             
     @property
     def tiffs(self):
@@ -78,23 +139,77 @@ class OnlineAnalysis:
             )
         return self._tiffs
     
+    @property
+    def session_tiffs(self):
+        """Tiffs in the folder from this session (not earlier ones), in file name order."""
+        return sorted(tiff for tiff in glob(self.folder_tiffs) if tiff not in self.previous_tiffs)
+    
+    def number_tiffs(self):
+        """
+        Gives every new tiff in the session the next acquisition number. Numbers are kept, so they
+        don't shift when validate_tiffs deletes a short tiff.
+        """
+        for tiff in self.session_tiffs:
+            if tiff not in self.tiff_numbers:
+                self.tiff_numbers[tiff] = len(self.tiff_numbers)
+    
+    def acq_numbers(self, tiffs):
+        """
+        Acquisition number (counting from 0) of each tiff in the session, ie. its place among the
+        session's tiffs in file name order when it first showed up, which is also the DAQ's trial
+        number.
+        """
+        self.number_tiffs()
+        return [self.tiff_numbers[tiff] for tiff in tiffs]
+    
+    @property
+    def unprocessed_tiffs(self):
+        """Finished tiffs (not the one SI is writing) that haven't been in a batch yet."""
+        return [tiff for tiff in glob(self.folder_tiffs)[:-1]
+                if tiff not in self.processed_tiffs and tiff not in self.previous_tiffs]
+    
     @property
     def json(self):
         self._json = {
-            'c': self.C.tolist(),
+            'c': np.asarray(self.C, dtype=self.dtype),
             'splits': self.splits,
-            'dff': self.dff.tolist(),
+            'dff': np.asarray(self.dff, dtype=self.dtype),
             'coords': self.coords.to_json(),
-            'times': self.times,
-            'cond': self.cond,
-            'vis_cond': self.vis_cond
+            **self.trial_data,
+            'frame_times': self.frame_times,
         }
         return self._json
     
+    @property
+    def trial_data(self):
+        """Stim times and conditions of the trials in this batch, from the event store if there is one."""
+        return self._trial_data(self.batch_trials)
+    
+    def _trial_data(self, trials):
+        if self.events is None:
+            return {'times': self.times, 'cond': self.cond, 'vis_cond': self.vis_cond}
+        trials = self.events.take(trials)
+        return {
+            'times': trials['stim_times'],
+            'cond': trials['condition'].tolist(),
+            'vis_cond': trials['vis_cond'].tolist(),
+        }
+    
+    @property
+    def frame_times(self):
+        """Acquisition time of each frame of the current plane in this batch."""
+        if self.frame_index is None:
+            return None
+        return self.frame_index.for_plane(self.plane).t
+    
     
     @property
     def splits(self):
         """This gets the frames numbers for each trial by reading the file name of the mmap."""
+        if self._batch_splits is not None:
+            # registered memmaps are written in one go, frame counts were kept while reading
+            self._splits = self._batch_splits[self.plane]
+            return self._splits
         # get all memmap files
         these_maps = glob(f'{self.folder}MAP{self.fnumber}_plane{self.plane}_a0*.mmap')
         # number of frames is the 2nd from the last thing in the file name
@@ -103,13 +218,11 @@ class OnlineAnalysis:
     
     
     def _start_cluster(self):
-        if 'self.dview' in locals():
-            cm.stop_server(dview=self.dview)
-        print('Starting local cluster...', end = ' ')
-        self.c, self.dview, self.n_processes = cm.cluster.setup_cluster(
-            backend='local', n_processes=None, single_thread=False)
+        # shared across instances/sessions, only actually starts the first time
+        self.pool = get_pool().ensure()
+        self.c = self.pool.c
+        self.n_processes = self.pool.n_processes
         self.dview = None
-        print('done.')
 
        
     ###------internal use methods-------###     
@@ -142,13 +255,48 @@ class OnlineAnalysis:
         ptoc(t, start_string='done in')
         
         
+    def configure_from_metadata(self, tiff=None):
+        """
+        Sets channels, planes and frame rate from the ScanImage header of a tiff (see metadata.py).
+        The header is cached, so this is cheap to call again.
+
+        Args:
+            tiff (str, optional): tiff to read. Defaults to the first tiff in the folder.
+
+        Returns:
+            SIMetadata
+        """
+        if tiff is None:
+            tiff = sorted(glob(self.folder_tiffs))[0]
+        self.metadata = read_metadata(tiff)
+        
+        self.channels = self.metadata.nchannels
+        self.planes = self.metadata.nplanes
+        if self.metadata.fr:
+            self.opts.change_params(dict(fr=self.metadata.fr))
+        self.configured = True
+        
+        print(f'Configured from {tiff}: {self.channels} channels, {self.planes} planes, '
+              f'{self.opts.data["fr"]} Hz')
+        return self.metadata
+        
+        
     def make_mmap(self, files):
         """Make memory mapped files for each plane in a set of tiffs."""
+        # frame headers only, so this is quick next to the memory mapping
+        self.frame_index = FrameIndex.from_tiffs(files, self.channels, self.planes,
+                                                 fr=self.opts.data['fr'])
+        if self.rigid_register:
+            return self.make_registered_mmap(files)
+        
         t = tic()
+        self._batch_splits = None
         memmap = []
         for plane in range(self.planes):
             print(f'Memory mapping current file, plane {plane}...')
             plane_slice = plane * self.channels
+            # a delete left over from the last session can't take the new file with the same name
+            self.janitor.reserve_prefix(f'{self.folder}MAP{self.fnumber}_plane{plane}_a')
             memmap.append(cm.save_memmap(
                 files,
                 base_name=f'MAP{self.fnumber}_plane{plane}_a', 
@@ -159,16 +307,64 @@ class OnlineAnalysis:
                     slice(self.x_start, self.x_end)
                 ]
             ))
+            # the final fit needs every batch's memmaps, don't let the quota take them
+            self.janitor.track(memmap[-1], 'mmap', protect=True)
         print(f'Memory mapping done. Took {toc(t):.4f}s')
         return memmap
         
         
+    def make_registered_mmap(self, files):
+        """
+        Same as make_mmap, but reads each tiff once for all planes and rigidly registers the frames
+        by FFT phase correlation (see registration.py) as they're written into the memmaps, so the
+        movies going to CNMF are already motion corrected. Each plane is registered to the same
+        template every batch (made from the first batch).
+        """
+        t = tic()
+        stride = self.channels * self.planes
+        movies = [[] for _ in range(self.planes)]
+        self._batch_splits = [[] for _ in range(self.planes)]
+        
+        for f in files:
+            with ScanImageTiffReader(f) as reader:
+                data = reader.data()
+            for plane in range(self.planes):
+                frames = data[plane * self.channels:-1:stride, 0:512, self.x_start:self.x_end]
+                movies[plane].append(frames)
+                self._batch_splits[plane].append(frames.shape[0])
+        
+        memmap = []
+        for plane in range(self.planes):
+            print(f'Registering and memory mapping plane {plane}...')
+            movie = np.concatenate(movies[plane])
+            movies[plane] = None
+            
+            template = self.reg_templates.get(plane)
+            if template is None:
+                template = make_template(movie)
+            base_name = f'{self.folder}MAP{self.fnumber}_plane{plane}_a'
+            self.janitor.reserve([memmap_name(base_name, movie.shape[1:], movie.shape[0])])
+            fname, big_mov, view = open_memmap_movie(base_name, movie.shape[1:], movie.shape[0])
+            _, shifts, self.reg_templates[plane] = register_rigid(
+                movie, template=template, out=view, **self.reg_opts)
+            big_mov.flush()
+            del big_mov, view
+            
+            print(f'Plane {plane} max shift: {np.abs(shifts).max(axis=0)}')
+            memmap.append(fname)
+            self.janitor.track(fname, 'mmap', protect=True)
+            
+        print(f'Registration and memory mapping done. Took {toc(t):.4f}s')
+        return memmap
+        
+        
     def make_movie(self, memmap):
         """
         Load memmaps and make the movie.
         """
         Yr, dims, T = cm.load_memmap(memmap)
         self.movie = np.reshape(Yr.T, [T] + list(dims), order='F')
+        self.janitor.watch(memmap, Yr)
         
         
     def validate_tiffs(self, bad_tiff_size=5):
@@ -179,7 +375,8 @@ class OnlineAnalysis:
         Args:
             bad_tiff_size (int, optional): Size tiffs must be to not be trashed. Defaults to 5.
         """
-        
+        # number them first, deleting one mustn't change the trial numbers of the ones after it
+        self.number_tiffs()
         crap = []
         for tiff in self.tiffs:
             with ScanImageTiffReader(tiff) as reader:
@@ -201,7 +398,10 @@ class OnlineAnalysis:
         self.coords = extract_cell_locs(cnm_seeded)
         cnm_seeded.estimates.detrend_df_f()
         self.dff = cnm_seeded.estimates.F_dff
-        cnm_seeded.save(self.save_folder + f'caiman_data_plane_{self.plane}_{self.fnumber:04}.hdf5')
+        hdf5_path = self.save_folder + f'caiman_data_plane_{self.plane}_{self.fnumber:04}.hdf5'
+        self.janitor.reserve([hdf5_path])
+        cnm_seeded.save(hdf5_path)
+        self.janitor.track(hdf5_path, 'hdf5')
         print(f'CNMF fitting done. Took {toc(t):.4f}s')
         return cnm_seeded.estimates.C
     
@@ -214,18 +414,83 @@ class OnlineAnalysis:
         t = tic()
         print('Using makeMasks3D sources as seeded input.')
         self.templates = [make_ain(path, plane, self.x_start, self.x_end) for plane in range(self.planes)]
+        self._projectors = {}
         ptoc(t)
         
         
-    def do_next_group(self):
+    def do_preview(self, memmap):
+        """
+        Quick traces for the current plane by projecting the batch's memmap straight onto the seed
+        footprints (see preview.py), no CNMF. The frames are only motion corrected with
+        rigid_register=True, otherwise they're projected as they are. Takes seconds instead of
+        minutes, and gets replaced by the real fit once it's done.
+
+        Args:
+            memmap (str): memmap file for the plane
+
+        Returns:
+            dict in the same format as the json property, with 'preview' set to True
+        """
+        opts = self.preview_opts
+        Yr, dims, T = cm.load_memmap(memmap)
+        
+        if self.plane not in self._projectors:
+            self._projectors[self.plane] = PreviewProjector(
+                self.templates[self.plane], dims, neuropil=opts['neuropil'], ssub=opts['ssub'])
+        c = self._projectors[self.plane].project(Yr, tsub=opts['tsub'])
+        
+        # frames kept from each trial when subsampling in time
+        splits = self.splits
+        starts = np.concatenate([[0], np.cumsum(splits)[:-1]])
+        splits = [len(range(-(-start // opts['tsub']) * opts['tsub'], start + n, opts['tsub']))
+                  for start, n in zip(starts, splits)]
+        
+        return {
+            'c': c.astype(self.dtype, copy=False),
+            'splits': splits,
+            'dff': preview_dff(c).astype(self.dtype, copy=False),
+            'coords': cell_locs_from_A(self.templates[self.plane], dims).to_json(),
+            **self.trial_data,
+            'frame_times': None if self.frame_times is None else self.frame_times[::opts['tsub']],
+            'fr': self.opts.data['fr'] / opts['tsub'], # rate of the subsampled traces
+            'preview': True
+        }
+        
+        
+    def do_next_group(self, batch=None):
         """
         Do the next iteration on a group of tiffs.
+
+        Args:
+            batch (int, optional): batch number, passed on to on_preview. Defaults to None.
         """
         self.validate_tiffs()
-        these_tiffs = self.tiffs[-self.batch_size:None]
+        these_tiffs = [tiff for tiff in self.tiffs
+                       if tiff not in self.processed_tiffs and tiff not in self.previous_tiffs]
+        # oldest first, so every tiff is fit once and batches stay in acquisition order even when
+        # more than a batch's worth is waiting (eg. after a resume)
+        these_tiffs = sorted(these_tiffs)[:self.batch_size]
         print(f'processing files: {these_tiffs}')
+        if self.auto_configure and not self.configured:
+            self.configure_from_metadata(these_tiffs[0])
         self.opts.change_params(dict(fnames=these_tiffs))
-        memmaps = self.make_mmap(these_tiffs) # gets the last x number of tiffs
+        self.batch_fnumber = self.fnumber
+        memmaps = self.make_mmap(these_tiffs)
+        self.memmaps.append(memmaps)
+        self.processed_tiffs.extend(these_tiffs)
+        self.batch_trials = self.acq_numbers(these_tiffs)
+        self.session_trials.extend(self.batch_trials)
+        
+        if self.preview:
+            t = tic()
+            previews = []
+            for plane, memmap in enumerate(memmaps):
+                self.plane = plane
+                previews.append(self.do_preview(memmap))
+            ptoc(t, start_string='Preview done in')
+            if self.on_preview is not None:
+                self.on_preview(previews, batch)
+        
         self.data_this_round = []
         for plane,memmap in enumerate(memmaps):
             print(f'PLANE {plane}')
@@ -238,34 +503,128 @@ class OnlineAnalysis:
             self.C = self.do_fit()
 
             # use the json prop to save data
-            self.data_this_round.append(self.json)
-            self.save_json()
+            data = self.json
+            self.data_this_round.append(data)
+            self.save_json(data=data)
+            self.session_splits.setdefault(plane, []).extend(data['splits'])
 
             ptoc(t, start_string=f'Plane {plane} done in')
 
+        self.record_frame_times(self.data_this_round)
         self.advance(by=self.batch_size)
         
         
-    def do_final_fit(self):
+    def record_frame_times(self, batch_data):
+        """Keeps each plane's frame times from a finished batch for the final fit."""
+        for plane, plane_data in enumerate(batch_data):
+            self.session_frame_times.setdefault(plane, []).append(plane_data.get('frame_times'))
+            
+            
+    def session_times(self, plane):
+        """Frame times of a plane across every batch so far, None if any batch is missing them."""
+        times = self.session_frame_times.get(plane, [])
+        if not times or any(t is None for t in times):
+            return None
+        return np.concatenate(times)
+        
+        
+    def do_final_fit(self, subsample_frames=3000, chunk_frames=None):
         """
-        Same thing as do_next_group() but catches all the tiffs. No [:-1] to
-        avoid grabbing the current SI tiff.
+        Refits the whole session, plane by plane, out of core (see finalfit.py). Footprints are fit
+        on a subsample of frames from across all the batches, then every batch memmap is projected
+        and deconvolved in parallel, so the full movie is never loaded. Saves
+        final_plane{n}.json (and the caiman hdf5) to save_folder.
+
+        Args:
+            subsample_frames (int, optional): frames used to fit footprints. Defaults to 3000.
+            chunk_frames (int, optional): max frames per chunk. Defaults to one chunk per batch.
         """
+        if not self.memmaps:
+            raise ValueError('No batches have been run, nothing to do a final fit on.')
         
-        all_tiffs = glob(self.folder_tiffs)
-        self.validate_tiffs()
-        these_tiffs = all_tiffs[-self.batch_size:None]
-        print(f'processing files: {these_tiffs}')
-        self.opts.change_params(dict(fnames=these_tiffs))
-        self.make_mmap(these_tiffs) # gets the last X number of tiffs
-        self.make_movie()
-        self.C = self.do_fit()
-        self.trial_lengths.append(self.splits)
-        self.save_json()
-        self.advance(by=self.batch_size)
+        for plane in range(self.planes):
+            print(f'FINAL FIT PLANE {plane}')
+            t = tic()
+            self.plane = plane
+            cnm = fit_chunked([batch[plane] for batch in self.memmaps], self.templates[plane],
+                              self.opts, self.n_processes, dview=self.dview,
+                              subsample_frames=subsample_frames, chunk_frames=chunk_frames)
+            self.coords = extract_cell_locs(cnm)
+            cnm.estimates.detrend_df_f()
+            self.dff = cnm.estimates.F_dff
+            self.C = cnm.estimates.C
+            hdf5_path = self.save_folder + f'caiman_data_plane_{plane}_final.hdf5'
+            self.janitor.reserve([hdf5_path])
+            cnm.save(hdf5_path)
+            self.janitor.track(hdf5_path, 'hdf5')
+            
+            # the traces cover the whole session, so the timing and trial data have to as well
+            data = self.json
+            data['splits'] = self.session_splits[plane]
+            data['frame_times'] = self.session_times(plane)
+            data.update(self._trial_data(self.session_trials))
+            self.save_result(os.path.join(self.save_folder, f'final_plane{plane}.json'), data)
+            ptoc(t, start_string=f'Final fit plane {plane} done in')
+            
         print('Caiman online analysis done.')
         
         
+    def checkpoint_state(self):
+        """What's needed to pick up where this left off, see checkpoint.py."""
+        return {
+            'fnumber': self.fnumber,
+            'processed_tiffs': list(self.processed_tiffs),
+            'previous_tiffs': sorted(self.previous_tiffs),
+            'tiff_numbers': dict(self.tiff_numbers),
+            'memmaps': list(self.memmaps),
+            'session_splits': dict(self.session_splits),
+            'session_trials': list(self.session_trials),
+            'reg_templates': dict(self.reg_templates),
+            'channels': self.channels,
+            'planes': self.planes,
+        }
+    
+    
+    def restore_state(self, state):
+        """Restores counters and warm-start state from checkpoint_state()."""
+        self.fnumber = state['fnumber']
+        self.processed_tiffs = state['processed_tiffs']
+        self.previous_tiffs = set(state.get('previous_tiffs', ()))
+        self.tiff_numbers = state.get('tiff_numbers', {})
+        self.memmaps = state['memmaps']
+        self.janitor.protect(path for batch in self.memmaps for path in batch)
+        self.session_splits = state['session_splits']
+        self.session_trials = state.get('session_trials', [])
+        self.session_frame_times = {} # from the batches themselves, see record_frame_times
+        self.reg_templates = state['reg_templates']
+        self.channels = state['channels']
+        self.planes = state['planes']
+        self.configured = True
+
+
+    def new_session(self):
+        """
+        Forgets the last session's batches so another one can be run with the same templates and
+        workers. Tiffs already in the folder belong to earlier sessions and are left alone (SI can
+        keep saving to the same folder), and fnumber keeps counting so memmap names don't clash.
+        """
+        self.previous_tiffs = set(glob(self.folder_tiffs))
+        self.tiff_numbers = {}
+        self.processed_tiffs = []
+        self.memmaps = []
+        self.janitor.release()
+        self.session_splits = {}
+        self.session_frame_times = {}
+        self.session_trials = []
+        self.reg_templates = {}
+        self.frame_index = None
+        self.batch_trials = []
+        self._batch_splits = None
+        self.movie = None
+        if self.auto_configure:
+            self.configured = False
+
+        
     def advance(self, by=1):
         """
         Advance the tiff file counts and whatever else needed by an interation count (for example
@@ -276,13 +635,40 @@ class OnlineAnalysis:
         """
         self.fnumber += by
     
-    def save_json(self, path=None):
+    def save_json(self, path=None, data=None, plane=None, fnumber=None):
+        """
+        Saves the json data for a plane (and the .npz sidecar if self.sidecar). If a writer is
+        attached, the write is queued on it and this returns right away.
+
+        Args:
+            path (str, optional): folder to save into. Defaults to save_folder.
+            data (dict, optional): data to save. Defaults to the current json property.
+            plane (int, optional): plane for the file name. Defaults to the current plane.
+            fnumber (int, optional): file number for the file name. Defaults to current fnumber.
+        """
         if path is None:
             path = self.save_folder
-        fname = f'data_out_plane{self.plane}_{self.fnumber:04}.json'
+        if data is None:
+            data = self.json
+        if plane is None:
+            plane = self.plane
+        if fnumber is None:
+            fnumber = self.fnumber
+        fname = f'data_out_plane{plane}_{fnumber:04}.json'
         path = os.path.join(path, fname)
-        with open(path, 'w') as outfile:
-            json.dump(self.json, outfile)
+        if self.writer is not None:
+            self.writer.submit(self.save_result, path, data)
+        else:
+            self.save_result(path, data)
+            
+            
+    def save_result(self, path, data):
+        """Writes a result file (see export.save_result) and tracks it for cleanup."""
+        self.janitor.reserve([path, sidecar_path(path)])
+        save_result(path, data, self.sidecar, dtype=self.dtype)
+        self.janitor.track(path)
+        if self.sidecar:
+            self.janitor.track(sidecar_path(path))
             
             
             
@@ -304,10 +690,10 @@ class SimulateAcq(OnlineAnalysis):
         """
         
         self._json = {
-            'c': self.C.tolist(),
+            'c': np.asarray(self.C, dtype=self.dtype),
             'splits': self.splits,
             'time': self.group_lenths,
-            'dff': self.dff.tolist(),
+            'dff': np.asarray(self.dff, dtype=self.dtype),
             'coords': self.coords.to_json()
         }
         
@@ -332,7 +718,7 @@ class SimulateAcq(OnlineAnalysis):
         t = tic()
         self.validate_tiffs()
         self.opts.change_params(dict(fnames=tiffs_to_run))
-        self.make_mmap(tiffs_to_run)
+        self.memmaps.append(self.make_mmap(tiffs_to_run))
         self.make_movie()
         self.C = self.do_fit()
         self.trial_lengths.append(self.splits)
@@ -348,12 +734,15 @@ class SimulateAcq(OnlineAnalysis):
         for tiff_group in tiff_list:
             self.do_next_group(tiff_group)
         self.do_final_fit()
-        cm.stop_server(dview=self.dview)
         
-    def do_final_fit(self):
+    def do_final_fit(self, chunked=False, **kwargs):
         """
-        Do the last fit on all the tiffs in the folder. This makes an entirely concenated cnmf fit.
+        Do the last fit on all the tiffs in the folder. This makes an entirely concenated cnmf fit,
+        or with chunked=True does the out-of-core fit from OnlineAnalysis.do_final_fit instead.
         """
+        if chunked:
+            return super().do_final_fit(**kwargs)
+        
         t = tic()
         print(f'processing files: {self.tiffs}')
         self.opts.change_params(dict(fnames=self.tiffs))
@@ -376,7 +765,7 @@ class SimulateAcq(OnlineAnalysis):
         cnm_seeded.fit(images)
         cnm_seeded.save(self.save_folder + 'FINAL_caiman_data.hdf5')
         
-        self.coords = cm.utils.visualization.get_contours(cnm_seeded.estimates.A, dims=cnm_seeded.dims)
+        self.coords = extract_cell_locs(cnm_seeded)
         cnm_seeded.estimates.detrend_df_f()
         self.dff = cnm_seeded.estimates.F_dff
         self.C = cnm_seeded.estimates.C
@@ -0,0 +1,178 @@
+"""
+ScanImage metadata. The header of each tiff is parsed once into an SIMetadata and cached by file,
+so getting the number of channels/planes/frame rate doesn't mean reopening and re-splitting the
+metadata string every time. The header is read straight from the start of the file, so it also
+works on a tiff ScanImage is still writing.
+"""
+
+from dataclasses import dataclass, field
+import os
+import re
+import struct
+import threading
+
+from ScanImageTiffReader import ScanImageTiffReader
+
+SI_MAGIC = 117637889
+
+_cache = {}
+_cache_lock = threading.Lock()
+_line_re = re.compile(r'^(?:scanimage\.)?(SI\.\S+)\s*=\s*(.*)$')
+
+
+@dataclass
+class SIMetadata:
+    """
+    The ScanImage settings the online analysis cares about, plus everything else in raw.
+
+    channels_saved = channels (1-indexed) that were saved
+    zs = z positions of the planes
+    frame_rate = imaging frame rate (all planes)
+    volume_rate = volume rate, ie. frame rate of each plane
+    frames_per_slice = frames at each z before moving on
+    lines_per_frame, pixels_per_line = size of each frame (y, x)
+    raw = every SI.* setting in the header, by name
+    """
+    path: str = None
+    channels_saved: tuple = (1,)
+    zs: tuple = (0,)
+    frame_rate: float = None
+    volume_rate: float = None
+    frames_per_slice: int = 1
+    lines_per_frame: int = 512
+    pixels_per_line: int = 512
+    raw: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def nchannels(self):
+        return len(self.channels_saved)
+
+    @property
+    def nplanes(self):
+        return len(self.zs)
+
+    @property
+    def fr(self):
+        """Frame rate of each plane."""
+        if self.nplanes > 1 and self.volume_rate:
+            return self.volume_rate
+        return self.frame_rate
+
+    @property
+    def dims(self):
+        """(y, x) size of each frame, before any cropping."""
+        return (self.lines_per_frame, self.pixels_per_line)
+
+    def crop_dims(self, x_start, x_end):
+        """(y, x) size of each plane after cropping x to x_start:x_end."""
+        return (self.lines_per_frame, len(range(self.pixels_per_line)[x_start:x_end]))
+
+
+def _parse_number(s):
+    try:
+        val = float(s)
+    except ValueError:
+        return s
+    return int(val) if val.is_integer() else val
+
+
+def _parse_value(s):
+    """Turns a matlab literal from the header into python (numbers, lists, bools, strings)."""
+    s = s.strip()
+    if s in ('true', 'false'):
+        return s == 'true'
+    if s.startswith("'") and s.endswith("'"):
+        return s[1:-1]
+    if s.startswith('[') and s.endswith(']'):
+        rows = [row.replace(',', ' ').split() for row in s[1:-1].split(';')]
+        rows = [[_parse_number(v) for v in row] for row in rows if row]
+        if len(rows) == 0:
+            return []
+        if len(rows) == 1 or all(len(row) == 1 for row in rows):
+            # row or column vector
+            return [v for row in rows for v in row]
+        return rows
+    return _parse_number(s)
+
+
+def parse_metadata(text, path=None):
+    """
+    Parses a ScanImage header (the 'SI.x = y' lines) into an SIMetadata.
+
+    Args:
+        text (str): frame-invariant metadata, eg. from ScanImageTiffReader.metadata()
+        path (str, optional): file it came from
+
+    Returns:
+        SIMetadata
+    """
+    raw = {}
+    for line in text.splitlines():
+        match = _line_re.match(line.strip())
+        if match:
+            raw[match.group(1)] = _parse_value(match.group(2))
+
+    def get(key, default):
+        val = raw.get(key, default)
+        return default if val == [] else val
+
+    def as_tuple(val):
+        return tuple(val) if isinstance(val, list) else (val,)
+
+    return SIMetadata(
+        path=path,
+        channels_saved=as_tuple(get('SI.hChannels.channelSave', 1)),
+        zs=as_tuple(get('SI.hStackManager.zs', 0)),
+        frame_rate=get('SI.hRoiManager.scanFrameRate', None),
+        volume_rate=get('SI.hRoiManager.scanVolumeRate', None),
+        frames_per_slice=get('SI.hStackManager.framesPerSlice', 1),
+        lines_per_frame=get('SI.hRoiManager.linesPerFrame', 512),
+        pixels_per_line=get('SI.hRoiManager.pixelsPerLine', 512),
+        raw=raw
+    )
+
+
+def _read_header(file):
+    """
+    Reads the frame-invariant metadata from the ScanImage header at the start of the tiff, without
+    touching any image data. Falls back to ScanImageTiffReader for files without that header
+    (older ScanImage versions).
+    """
+    with open(file, 'rb') as f:
+        byteorder, version = struct.unpack('<2sH', f.read(4))
+        # BigTIFF header is 16 bytes, classic tiff is 8
+        f.seek(16 if version == 43 else 8)
+        magic, si_version, size0, size1 = struct.unpack('<IIII', f.read(16))
+        if byteorder == b'II' and magic == SI_MAGIC:
+            return f.read(size0).decode('utf-8', errors='replace')
+
+    with ScanImageTiffReader(file) as reader:
+        return reader.metadata()
+
+
+def read_metadata(file, refresh=False):
+    """
+    Gets the ScanImage metadata for a tiff, parsing it only the first time a file is seen.
+
+    Args:
+        file (str): path to the tiff
+        refresh (bool, optional): ignore the cache and parse it again. Defaults to False.
+
+    Returns:
+        SIMetadata
+    """
+    key = os.path.abspath(file)
+    with _cache_lock:
+        if not refresh and key in _cache:
+            return _cache[key]
+
+    meta = parse_metadata(_read_header(file), path=file)
+
+    with _cache_lock:
+        _cache[key] = meta
+    return meta
+
+
+def clear_metadata_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -12,6 +12,7 @@ Note: this is import websocket NOT websockets (annoying, I know)
 Callbacks in run_caiman_ws.py must match exactly!
 """
 import websocket
+import os
 import sys
 import json
 
@@ -20,8 +21,11 @@ import json
 IP = '192.168.10.104'
 PORT = 5003
 
+# session ID for a MultiSessionServer (one per rig), set CAIMAN_SESSION to use it from the command line
+SESSION = os.environ.get('CAIMAN_SESSION')
 
-def send_this(message, ip=IP, port=PORT):
+
+def send_this(message, ip=IP, port=PORT, session=None):
     """
     Takes a message and sends it to the caiman WS server via formatted JSON.
 
@@ -29,7 +33,13 @@ def send_this(message, ip=IP, port=PORT):
         message (str, dict): python string or dictionary to send, formatted to a JSON
         ip (str, optional): IP location of host. Defaults to IP.
         port (int, optional): WS port on host. Defaults to PORT.
+        session (str, optional): session ID to send it to on a MultiSessionServer. Defaults to
+                                 SESSION.
     """
+    if session is None:
+        session = SESSION
+    if session is not None:
+        message = {'session': session, 'message': message}
     message = json.dumps(message)
     url = f'ws://{ip}:{port}'
     ws = websocket.create_connection(url)
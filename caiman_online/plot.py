@@ -7,6 +7,7 @@ from matplotlib.gridspec import GridSpec
 import numpy as np
 import seaborn as sns
 from .statistics import traces_ci
+from .utils import tic, toc
 
 mpl.rcParams['figure.constrained_layout.use'] = True
 mpl.rcParams['savefig.dpi'] = 300 # default resolution for saving images in matplotlib
@@ -14,11 +15,11 @@ mpl.rcParams['savefig.format'] = 'png' # defaults to png for saved images (SVG i
 mpl.rcParams['savefig.bbox'] = 'tight' # so saved graphics don't get chopped
 sns.set_style('ticks',{'axes.spines.right': False, 'axes.spines.top': False}) # removes annoying top and right axis
         
-def mean_traces_ci(data, ci=0.95, ax=None):
+def mean_traces_ci(data, ci=0.95, ax=None, method='t'):
     if ax is None:
         ax=plt.gca()
         
-    cis = traces_ci(data, confidence=ci)
+    cis = traces_ci(data, confidence=ci, method=method)
 
     ax.plot(data.mean(axis=0), color='k', lw=2)
     ax.fill_between(np.arange(data.shape[1]), cis[0,:], cis[1,:], alpha=0.6)    
@@ -121,6 +122,139 @@ def example_tuning(mdf, n_examples=4, **sns_kws):
         col='cell', kind='point', **sns_kws
     )
     
+class LiveDashboard:
+    """
+    Live tuning display that makes its figure once and then just updates the artists in place
+    (image data and bar heights) with blitting, instead of closing and redrawing every figure.
+    Call update() with new results whenever they come in (cheap, just stores them) and render()
+    from wherever drawing should happen. render() redraws at most once every min_interval seconds.
+
+    min_interval = minimum time between redraws in seconds
+    blank = condition value of the gray screen/blank trials, not shown
+    """
+    hist_bins = {
+        'pref': np.linspace(0, 180, 9),
+        'pdir': np.linspace(0, 360, 9),
+        'osi': np.linspace(0, 1, 21),
+    }
+    
+    def __init__(self, min_interval=1.0, blank=-45):
+        self.min_interval = min_interval
+        self.blank = blank
+        
+        self.fig = None
+        self.conds = None
+        self.images = []
+        self.bars = {}
+        self.background = None
+        
+        self._pending = None
+        self._last_draw = None
+        
+    def update(self, cell_df, mean_traces, conds):
+        """
+        Stores new results to draw on the next render().
+
+        Args:
+            cell_df (pd.DataFrame): per cell tuning, from vis.IncrementalTuning.summary
+            mean_traces (array): conds x cells x time mean traces
+            conds (array-like): condition of each entry in mean_traces
+        """
+        self._pending = (cell_df, mean_traces, np.asarray(conds))
+        
+    @property
+    def dirty(self):
+        return self._pending is not None
+    
+    def _setup(self, mean_traces, conds):
+        if self.fig is not None:
+            plt.close(self.fig)
+        plt.ion()
+        
+        keep = conds != self.blank
+        self.conds = conds
+        n = max(int(keep.sum()), len(self.hist_bins))
+        
+        self.fig = plt.figure(figsize=(10, 2*n))
+        gs = GridSpec(n, 2, figure=self.fig)
+        
+        self.images = []
+        for row, cond in enumerate(conds[keep]):
+            ax = self.fig.add_subplot(gs[row, 0])
+            im = ax.imshow(mean_traces[conds == cond][0], aspect='auto', cmap='viridis',
+                           animated=True)
+            ax.set_ylabel(f'{cond:g} deg')
+            self.images.append((cond, im))
+        if self.images:
+            # only the bottom trace panel gets a label, and there are none if it's all blanks so far
+            ax.set_xlabel('Time')
+        
+        self.bars = {}
+        rows = np.array_split(np.arange(n), len(self.hist_bins))
+        for (name, bins), these_rows in zip(self.hist_bins.items(), rows):
+            ax = self.fig.add_subplot(gs[these_rows[0]:these_rows[-1]+1, 1])
+            bars = ax.bar(bins[:-1], np.zeros(bins.size-1), width=np.diff(bins), align='edge',
+                          animated=True)
+            ax.set_xlabel(name)
+            ax.set_ylabel('Count')
+            ax.set_ylim(0, 10)
+            self.bars[name] = (ax, bars)
+        
+        self._full_draw()
+        
+    def _full_draw(self):
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        
+    def render(self, force=False):
+        """
+        Draws the latest results if there are any and min_interval has passed.
+
+        Returns:
+            bool: whether anything was drawn
+        """
+        if not self.dirty:
+            return False
+        if not force and self._last_draw is not None and toc(self._last_draw) < self.min_interval:
+            return False
+        
+        cell_df, mean_traces, conds = self._pending
+        self._pending = None
+        self._last_draw = tic()
+        
+        if self.fig is None or not plt.fignum_exists(self.fig.number) or \
+                not np.array_equal(conds, self.conds):
+            self._setup(mean_traces, conds)
+        
+        needs_full_draw = False
+        for cond, im in self.images:
+            data = mean_traces[conds == cond][0]
+            im.set_data(data)
+            im.set_extent((-0.5, data.shape[1]-0.5, data.shape[0]-0.5, -0.5))
+            im.set_clim(np.nanmin(data), np.nanmax(data))
+        
+        vals = cell_df[cell_df.vis_resp == True]
+        for name, (ax, bars) in self.bars.items():
+            counts, _ = np.histogram(vals[name].dropna(), bins=self.hist_bins[name])
+            for bar, count in zip(bars, counts):
+                bar.set_height(count)
+            if counts.max(initial=0) > ax.get_ylim()[1]:
+                ax.set_ylim(0, counts.max() * 1.5)
+                needs_full_draw = True
+        
+        canvas = self.fig.canvas
+        if needs_full_draw:
+            self._full_draw()
+        canvas.restore_region(self.background)
+        for _, im in self.images:
+            self.fig.draw_artist(im)
+        for ax, bars in self.bars.values():
+            for bar in bars:
+                self.fig.draw_artist(bar)
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+        return True
+    
     
 # def pl
             
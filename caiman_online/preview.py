@@ -0,0 +1,98 @@
+"""
+Fast preview traces for seeded ROIs. Instead of a CNMF fit, each frame is projected onto the
+(normalized) seed footprints, which is one sparse matrix product for the whole movie. Optionally
+subtracts a neuropil ring around each cell and subsamples in space/time to go even faster. Good
+enough to act on while the real fit is still running.
+"""
+
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+
+
+def _spatial_subsample(A, dims, ssub):
+    """Keeps only the footprint pixels on every ssub-th row and column."""
+    if ssub == 1:
+        return A
+    rows, cols = np.unravel_index(np.arange(A.shape[0]), dims, order='F')
+    keep = ((rows % ssub == 0) & (cols % ssub == 0)).astype(A.dtype)
+    return scipy.sparse.diags(keep) @ A
+
+
+def _normalize_columns(A):
+    """Scales each column to sum to 1 so the projection is a weighted mean."""
+    sums = np.asarray(A.sum(axis=0)).ravel()
+    sums[sums == 0] = 1
+    return A @ scipy.sparse.diags(1 / sums)
+
+
+def neuropil_rings(A, dims, inner=2, outer=7):
+    """
+    Makes a ring around each footprint for neuropil, excluding every cell's pixels.
+
+    Args:
+        A (array or sparse): pixels x cells footprints, pixels in F order
+        dims (tuple): (y, x) size of the plane
+        inner (int, optional): gap between the cell and the ring in pixels. Defaults to 2.
+        outer (int, optional): outer edge of the ring in pixels. Defaults to 7.
+
+    Returns:
+        sparse pixels x cells ring masks
+    """
+    A = scipy.sparse.csc_matrix(A)
+    any_cell = np.asarray(A.sum(axis=1)).ravel().reshape(dims, order='F') > 0
+    inner_struct = scipy.ndimage.generate_binary_structure(2, 1)
+
+    rings = []
+    for i in range(A.shape[1]):
+        mask = A[:, i].toarray().ravel().reshape(dims, order='F') > 0
+        near = scipy.ndimage.binary_dilation(mask, inner_struct, iterations=inner)
+        far = scipy.ndimage.binary_dilation(mask, inner_struct, iterations=outer)
+        ring = far & ~near & ~any_cell
+        rings.append(scipy.sparse.csc_matrix(ring.ravel(order='F')[:, None]))
+
+    return scipy.sparse.hstack(rings, format='csc').astype(np.float32)
+
+
+class PreviewProjector:
+    """
+    Precomputes projection weights for one plane's seeds so each batch is a single product.
+
+    A = pixels x cells seed footprints (eg. from make_ain), pixels in F order like caiman memmaps
+    dims = (y, x) size of the plane
+    neuropil = subtract a neuropil ring from each cell
+    neuropil_coef = how much of the neuropil to subtract
+    ring = (inner, outer) sizes of the neuropil ring, see neuropil_rings
+    ssub = spatial subsampling, only every ssub-th pixel in each direction is used
+    """
+    def __init__(self, A, dims, neuropil=False, neuropil_coef=0.7, ring=(2, 7), ssub=1):
+        A = scipy.sparse.csc_matrix(A, dtype=np.float32)
+        weights = _normalize_columns(_spatial_subsample(A, dims, ssub))
+        if neuropil:
+            rings = _normalize_columns(_spatial_subsample(neuropil_rings(A, dims, *ring), dims, ssub))
+            weights = weights - neuropil_coef * rings
+        # cells x pixels, CSR so the product runs row by row
+        self.weights = scipy.sparse.csr_matrix(weights.T, dtype=np.float32)
+        self.dims = dims
+
+    def project(self, Yr, tsub=1):
+        """
+        Gets traces from a movie.
+
+        Args:
+            Yr (array): pixels x time movie (eg. from cm.load_memmap)
+            tsub (int, optional): only use every tsub-th frame. Defaults to 1.
+
+        Returns:
+            cells x time array of traces
+        """
+        if tsub > 1:
+            Yr = Yr[:, ::tsub]
+        return np.asarray(self.weights @ Yr, dtype=np.float32)
+
+
+def preview_dff(traces, percentile=8):
+    """Quick dF/F using a low percentile of each trace as F0."""
+    f0 = np.percentile(traces, percentile, axis=1, keepdims=True)
+    f0[f0 == 0] = 1
+    return (traces - f0) / np.abs(f0)
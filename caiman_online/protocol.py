@@ -0,0 +1,228 @@
+"""
+Binary result frames for pushing caiman results to the DAQ as each batch finishes. Each frame is
+one plane of one batch:
+
+    magic (4 bytes) | header length (uint32) | JSON header | padding | array buffers
+
+The header has the sequence number, batch/plane info, any small metadata (splits, conditions,
+cell locations) and the name, dtype, shape and offset of each array. Arrays on the receiving end
+are numpy views straight into the message, nothing is copied or parsed. Arrays can also be sent as
+float16, or quantized to an integer type (eg. uint16) with a per-row offset and scale, which are
+turned back into float32 when unpacked.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from .timing import align_planes
+
+MAGIC = b'CMR1'
+_PREFIX = struct.Struct('<4sI')
+_ALIGN = 8
+
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _rows(arr):
+    """arr as a 2D array of rows along the last axis."""
+    if arr.ndim < 2:
+        return arr.reshape(1, arr.size)
+    return arr.reshape(int(np.prod(arr.shape[:-1])), arr.shape[-1])
+
+
+def _quantize_params(arr, dtype):
+    """Per-row offset and scale that map arr onto the full range of integer dtype."""
+    rows = _rows(arr)
+    if rows.size == 0:
+        return np.zeros((rows.shape[0], 1)), np.ones((rows.shape[0], 1))
+    info = np.iinfo(dtype)
+    lo = rows.min(axis=1, keepdims=True).astype(np.float64)
+    scale = (rows.max(axis=1, keepdims=True) - lo) / (info.max - info.min)
+    scale[scale == 0] = 1
+    return lo - info.min * scale, scale
+
+
+def pack_result(seq, arrays, dtype=np.float32, **meta):
+    """
+    Packs arrays and metadata into one binary frame.
+
+    Args:
+        seq (int): sequence number of this frame, used by the client to put frames back in order
+        arrays (dict): name -> array-like, each gets cast to dtype
+        dtype (optional): dtype to send arrays as. Integer dtypes quantize each row linearly.
+                          Defaults to np.float32.
+        **meta: anything JSON serializable to put in the header (eg. batch, plane, splits)
+
+    Returns:
+        bytearray: the frame, ready to send over the websocket
+    """
+    arrays = {name: np.asarray(arr) for name, arr in arrays.items()}
+    dtype = np.dtype(dtype)
+    quantized = dtype.kind in 'ui'
+
+    specs = []
+    quant = []
+    offset = 0
+    for name, arr in arrays.items():
+        nbytes = arr.size * dtype.itemsize
+        spec = {
+            'name': name,
+            'dtype': dtype.str,
+            'shape': list(arr.shape),
+            'offset': offset,
+        }
+        if quantized:
+            lo, scale = _quantize_params(arr, dtype)
+            spec['q_offset'] = lo.ravel().tolist()
+            spec['q_scale'] = scale.ravel().tolist()
+            quant.append((lo, scale))
+        specs.append(spec)
+        offset = _aligned(offset + nbytes)
+
+    header = dict(meta, seq=seq, arrays=specs)
+    header = json.dumps(header).encode('utf-8')
+    data_start = _aligned(_PREFIX.size + len(header))
+
+    frame = bytearray(data_start + offset)
+    _PREFIX.pack_into(frame, 0, MAGIC, len(header))
+    frame[_PREFIX.size:_PREFIX.size + len(header)] = header
+
+    # cast straight into the frame instead of making a temp copy first
+    for i, (spec, arr) in enumerate(zip(specs, arrays.values())):
+        out = np.frombuffer(frame, dtype=dtype, count=arr.size, offset=data_start + spec['offset'])
+        if quantized:
+            lo, scale = quant[i]
+            out[:] = np.rint((_rows(arr) - lo) / scale).ravel()
+        else:
+            out[:] = arr.ravel()
+
+    return frame
+
+
+def unpack_result(frame):
+    """
+    Unpacks a frame made by pack_result.
+
+    Args:
+        frame (bytes-like): the received message
+
+    Returns:
+        dict: the header
+        dict: name -> array, read-only views into frame (float32 copies for quantized arrays)
+    """
+    magic, header_len = _PREFIX.unpack_from(frame, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a caiman result frame.')
+
+    header = json.loads(bytes(frame[_PREFIX.size:_PREFIX.size + header_len]))
+    data_start = _aligned(_PREFIX.size + header_len)
+
+    arrays = {}
+    for spec in header.pop('arrays'):
+        count = int(np.prod(spec['shape']))
+        arr = np.frombuffer(frame, dtype=spec['dtype'], count=count,
+                            offset=data_start + spec['offset'])
+        if 'q_scale' in spec:
+            scale = np.array(spec['q_scale'], dtype=np.float32)[:, None]
+            lo = np.array(spec['q_offset'], dtype=np.float32)[:, None]
+            arr = _rows(arr.reshape(spec['shape'])) * scale + lo
+        arrays[spec['name']] = arr.reshape(spec['shape'])
+
+    return header, arrays
+
+
+class ResultAssembler:
+    """
+    Puts result frames back together on the client. Frames are applied in sequence order (early
+    ones wait for the gaps to fill), counting from 0 for each subscription, and once every plane of a batch has arrived the planes are
+    stacked (trimmed to the fewest frames) into one cells x time batch. Preview and full results
+    for the same batch are kept apart, and previews aren't part of session().
+    """
+    def __init__(self):
+        self.next_seq = 0
+        self._waiting = {}
+        self._planes = {}
+
+        self.batches = []
+
+    def add(self, header, arrays):
+        """
+        Adds a frame.
+
+        Returns:
+            list: batches completed by this frame (often empty), each a dict with 'c', 'dff',
+                  'splits', 'cond', 'vis_cond', 'com', 'fr', 'frame_times' and 'preview'
+        """
+        self._waiting[header['seq']] = (header, arrays)
+
+        done = []
+        while self.next_seq in self._waiting:
+            header, arrays = self._waiting.pop(self.next_seq)
+            self.next_seq += 1
+            batch = self._add_plane(header, arrays)
+            if batch is not None:
+                done.append(batch)
+        return done
+
+    def _add_plane(self, header, arrays):
+        key = (header['batch'], header.get('preview', False))
+        planes = self._planes.setdefault(key, {})
+        planes[header['plane']] = (header, arrays)
+        if len(planes) < header['nplanes']:
+            return None
+
+        del self._planes[key]
+        planes = [planes[p] for p in sorted(planes)]
+
+        frame_times = [header.get('frame_times') for header, _ in planes]
+        if all(t is not None for t in frame_times):
+            # put every plane on plane 0's frame times
+            c, times = align_planes([arrays['c'] for _, arrays in planes], frame_times)
+            dff, _ = align_planes([arrays['dff'] for _, arrays in planes], frame_times)
+        else:
+            fewest_frames = min(arrays['c'].shape[1] for _, arrays in planes)
+            c = np.concatenate([arrays['c'][:, :fewest_frames] for _, arrays in planes])
+            dff = np.concatenate([arrays['dff'][:, :fewest_frames] for _, arrays in planes])
+            times = None
+
+        first = planes[0][0]
+        batch = {
+            'batch': first['batch'],
+            'preview': first.get('preview', False),
+            'fr': first.get('fr'),
+            'c': c.astype(np.float32, copy=False),
+            'dff': dff.astype(np.float32, copy=False),
+            'frame_times': times,
+            'splits': first['splits'],
+            'cond': first['cond'],
+            'vis_cond': first['vis_cond'],
+            'com': [loc for header, _ in planes for loc in header['com']],
+        }
+        if not batch['preview']:
+            self.batches.append(batch)
+        return batch
+
+    def session(self):
+        """
+        Everything received so far joined end to end.
+
+        Returns:
+            dict: same keys as a batch, with c/dff as cells x all frames and trialwise lists joined
+        """
+        if not self.batches:
+            return None
+        ncells = min(b['c'].shape[0] for b in self.batches)
+        return {
+            'c': np.concatenate([b['c'][:ncells] for b in self.batches], axis=1),
+            'dff': np.concatenate([b['dff'][:ncells] for b in self.batches], axis=1),
+            'frame_times': (np.concatenate([b['frame_times'] for b in self.batches])
+                            if all(b['frame_times'] is not None for b in self.batches) else None),
+            'splits': [s for b in self.batches for s in b['splits']],
+            'cond': [c for b in self.batches for c in (b['cond'] or [])],
+            'vis_cond': [c for b in self.batches for c in (b['vis_cond'] or [])],
+            'com': self.batches[-1]['com'][:ncells],
+        }
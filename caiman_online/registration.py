@@ -0,0 +1,170 @@
+"""
+Lightweight rigid registration by FFT phase correlation. Frames are registered in batches (one
+multithreaded FFT for the whole batch) in float32, with optional subpixel refinement by upsampled
+DFT, and shifted in Fourier space. Fast enough to run while the tiffs are being memory mapped,
+which is all that's needed for mostly-rigid preps.
+
+Uses pyFFTW if it's installed, otherwise scipy.fft.
+"""
+
+import os
+
+import numpy as np
+
+try:
+    import pyfftw.interfaces.scipy_fft as fft
+except ImportError:
+    import scipy.fft as fft
+
+
+def _workers(n_threads):
+    return n_threads if n_threads is not None else os.cpu_count()
+
+
+def _upsampled_dft(data, region, upsample, offsets):
+    """
+    Upsampled cross correlation in a small region around each frame's peak, by matrix-multiply
+    DFT (Guizar-Sicairos et al. 2008). Batched over frames.
+
+    Args:
+        data (array): n x H x W cross power spectra
+        region (int): size of the upsampled region
+        upsample (int): upsampling factor
+        offsets (array): n x 2 offsets of the region for each frame
+
+    Returns:
+        n x region x region upsampled cross correlation
+    """
+    n, H, W = data.shape
+    ups = np.arange(region)
+    row_kernel = np.exp(-2j * np.pi * (ups[None, :, None] - offsets[:, 0, None, None])
+                        * np.fft.fftfreq(H, upsample)[None, None, :])
+    col_kernel = np.exp(-2j * np.pi * (ups[None, :, None] - offsets[:, 1, None, None])
+                        * np.fft.fftfreq(W, upsample)[None, None, :])
+    return np.einsum('nuh,nhw,nvw->nuv', row_kernel, data, col_kernel)
+
+
+def _shifts_from_spectra(frames_freq, template_freq, max_shift=None, upsample=1, n_threads=None):
+    """Shifts that register each frame to the template, from their spectra."""
+    product = template_freq[None] * frames_freq.conj()
+    product /= np.abs(product) + np.finfo(np.float32).eps
+
+    cc = fft.ifft2(product, workers=_workers(n_threads)).real
+    n, H, W = cc.shape
+
+    if max_shift is not None:
+        # only allow peaks within max_shift of zero
+        my, mx = max_shift
+        ys = np.fft.fftfreq(H, 1/H)
+        xs = np.fft.fftfreq(W, 1/W)
+        allowed = (np.abs(ys)[:, None] <= my) & (np.abs(xs)[None, :] <= mx)
+        cc[:, ~allowed] = -np.inf
+
+    peaks = cc.reshape(n, -1).argmax(axis=1)
+    shifts = np.stack(np.unravel_index(peaks, (H, W)), axis=1).astype(np.float64)
+    # wrap to signed shifts
+    shifts[:, 0] -= (shifts[:, 0] > H // 2) * H
+    shifts[:, 1] -= (shifts[:, 1] > W // 2) * W
+
+    if upsample > 1:
+        shifts = np.round(shifts * upsample) / upsample
+        region = int(np.ceil(upsample * 1.5))
+        dftshift = np.fix(region / 2.0)
+        offsets = dftshift - shifts * upsample
+        ucc = _upsampled_dft(product.conj(), region, upsample, offsets).conj()
+        maxima = ucc.reshape(n, -1).real.argmax(axis=1)
+        maxima = np.stack(np.unravel_index(maxima, (region, region)), axis=1) - dftshift
+        shifts = shifts + maxima / upsample
+
+    return shifts
+
+
+def _apply_shifts(frames_freq, shifts, n_threads=None):
+    """Shifts frames (given as spectra) by sub-pixel amounts with a Fourier phase ramp."""
+    n, H, W = frames_freq.shape
+    ky = np.fft.fftfreq(H).astype(np.float32)
+    kx = np.fft.fftfreq(W).astype(np.float32)
+    ramp = np.exp(-2j * np.pi * (shifts[:, 0, None, None].astype(np.float32) * ky[None, :, None]
+                                 + shifts[:, 1, None, None].astype(np.float32) * kx[None, None, :]))
+    return fft.ifft2(frames_freq * ramp, workers=_workers(n_threads)).real.astype(np.float32)
+
+
+def make_template(frames, n_frames=200):
+    """Mean of (up to) the first n_frames frames, as float32."""
+    return np.asarray(frames[:n_frames], dtype=np.float32).mean(axis=0)
+
+
+def register_rigid(frames, template=None, max_shift=None, upsample=1, batch_size=200,
+                   n_threads=None, out=None):
+    """
+    Rigidly registers frames to a template by phase correlation.
+
+    Args:
+        frames (array): T x H x W movie
+        template (array, optional): H x W image to register to. Defaults to the mean of the first
+                                    frames (see make_template).
+        max_shift (tuple, optional): largest (y, x) shift allowed in pixels. Defaults to None.
+        upsample (int, optional): subpixel upsampling factor, 1 is whole pixels. Defaults to 1.
+        batch_size (int, optional): frames per FFT batch, trades memory for speed. Defaults to 200.
+        n_threads (int, optional): FFT threads. Defaults to all cores.
+        out (array, optional): T x H x W float32 array (or memmap view) to write into.
+
+    Returns:
+        registered float32 movie (out if given)
+        T x 2 array of (y, x) shifts applied
+        the template used
+    """
+    if template is None:
+        template = make_template(frames)
+    template_freq = fft.fft2(np.asarray(template, dtype=np.float32), workers=_workers(n_threads))
+
+    T = frames.shape[0]
+    if out is None:
+        out = np.empty(frames.shape, dtype=np.float32)
+    shifts = np.zeros((T, 2))
+
+    for start in range(0, T, batch_size):
+        stop = min(start + batch_size, T)
+        chunk = np.asarray(frames[start:stop], dtype=np.float32)
+        chunk_freq = fft.fft2(chunk, workers=_workers(n_threads))
+        shifts[start:stop] = _shifts_from_spectra(chunk_freq, template_freq, max_shift, upsample,
+                                                  n_threads)
+        out[start:stop] = _apply_shifts(chunk_freq, shifts[start:stop], n_threads)
+
+    return out, shifts, template
+
+
+def memmap_name(base_name, dims, T, order='C'):
+    """Memmap file name in the format caiman uses (and cm.load_memmap expects)."""
+    return f'{base_name}_d1_{dims[0]}_d2_{dims[1]}_d3_1_order_{order}_frames_{T}_.mmap'
+
+
+def open_memmap_movie(base_name, dims, T):
+    """
+    Makes a caiman style C order memmap (pixels x time, pixels in F order) that cm.load_memmap can
+    read, and gives back a T x H x W view of it so frames can be written straight in.
+
+    Returns:
+        str: the memmap file name
+        np.memmap: the memmap itself (pixels x time)
+        T x H x W writable view
+    """
+    fname = memmap_name(base_name, dims, T)
+    big_mov = np.memmap(fname, mode='w+', dtype=np.float32, shape=(int(np.prod(dims)), T), order='C')
+    # pixel p = y + H*x, so rows of big_mov are (x, y) in C order
+    view = big_mov.reshape(dims[1], dims[0], T).transpose(2, 1, 0)
+    return fname, big_mov, view
+
+
+def save_memmap_frames(movie, base_name):
+    """
+    Saves a T x H x W movie as a caiman style memmap (see open_memmap_movie).
+
+    Returns:
+        str: the memmap file name
+    """
+    fname, big_mov, view = open_memmap_movie(base_name, movie.shape[1:], movie.shape[0])
+    view[:] = movie
+    big_mov.flush()
+    del big_mov
+    return fname
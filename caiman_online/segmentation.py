@@ -1,4 +1,8 @@
+import os
+import shutil
+import tempfile
 import warnings
+from contextlib import contextmanager
 
 with warnings.catch_warnings():
     warnings.simplefilter('ignore', category=FutureWarning)
@@ -6,10 +10,56 @@ with warnings.catch_warnings():
     from caiman.source_extraction.cnmf import params as params
     from caiman.motion_correction import MotionCorrect
 
+import numpy as np
 from tifffile import tifffile
 from ScanImageTiffReader import ScanImageTiffReader
 import matplotlib.pyplot as plt
 
+from .registration import make_template, register_rigid
+from .utils import tic, toc
+from .workers import get_pool
+
+
+def _registered_movie(path, max_shift):
+    """Loads one plane's frames (see MakeMasks3D.plane_arrays) and rigidly registers them."""
+    movie = np.load(path, mmap_mode='r')
+    # one FFT thread per worker, the planes are already running in parallel
+    registered, _, _ = register_rigid(movie, template=make_template(movie), max_shift=max_shift,
+                                      n_threads=1)
+    return registered
+
+
+def _register_plane(args):
+    """Rigidly registers one plane's frames and returns the mean corrected image."""
+    path, max_shift = args
+    return _registered_movie(path, max_shift).mean(axis=0)
+
+
+def _corr_image(movie):
+    return cm.local_correlations(movie, swap_dim=False)
+
+
+def _registered_corr_image(args):
+    """Correlation image of one plane's registered frames."""
+    path, max_shift = args
+    return _corr_image(_registered_movie(path, max_shift))
+
+
+def _plane_masks(image):
+    """Binary masks and their contours from one plane's mean image."""
+    masks = cm.base.rois.extract_binary_masks_from_structural_channel(image)[0]
+    coords = cm.utils.visualization.get_contours(masks, image.shape, thr=0.99, thr_method='max')
+    return masks, coords
+
+
+def _segment_plane(args):
+    """Every segmentation step for one plane: registration, masks and contours, correlation image."""
+    path, max_shift, corr = args
+    movie = _registered_movie(path, max_shift)
+    image = movie.mean(axis=0)
+    masks, coords = _plane_masks(image)
+    corr_im = _corr_image(movie) if corr else None
+    return image, masks, coords, corr_im
 
 
 class MakeMasks3D:
@@ -38,15 +88,53 @@ class MakeMasks3D:
         self.coords = None
         self.corr_images = []
         
-    def crop_tiffs(self):
+    def crop_tiffs(self, save=False):
+        """
+        Reads the template tiff once and splits it into planes in memory. Set save=True to also
+        write each plane out as a tiff (needed for motion_correct_red(method='caiman')).
+        """
+        with ScanImageTiffReader(self.tiff) as reader:
+            data = reader.data()
+        
         self.images = []
         self.file_list = []
         for plane in list(range(self.planes)):
             time_slice = slice(plane*self.channels+self.channel2use, -1, self.channels*self.planes)
-            with ScanImageTiffReader(self.tiff) as reader:
-                data = reader.data()
-                data = data[time_slice, : , self.xslice]
-            self.images.append(data)
+            self.images.append(data[time_slice, : , self.xslice])
+        
+        if save:
+            self.save_planes()
+            
+    def _mc_method(self, method):
+        if method == 'rigid' and self.mc_opts and self.mc_opts.get('pw_rigid'):
+            warnings.warn("mc_opts asks for pw_rigid, using caiman motion correction instead of 'rigid'.")
+            return 'caiman'
+        return method
+    
+    @property
+    def max_shift(self):
+        return self.opts.motion['max_shifts'] if self.mc_opts else None
+            
+    @contextmanager
+    def plane_arrays(self):
+        """
+        Writes each plane to a .npy file in a temp folder, so workers can memory map them instead
+        of having the whole stack pickled over to them. Gives the file names, and deletes them after.
+        """
+        folder = tempfile.mkdtemp(prefix='caiman_template_')
+        try:
+            paths = []
+            for plane, data in enumerate(self.images):
+                paths.append(os.path.join(folder, f'plane{plane}.npy'))
+                np.save(paths[-1], data)
+            yield paths
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            
+    def save_planes(self):
+        """Writes each plane of the template tiff to its own tiff file next to the original."""
+        self.file_list = []
+        for plane, data in enumerate(self.images):
             tif_name = self.tiff.split('.')[0] + '_template_plane' + str(plane) + '.tif'
             self.file_list.append(tif_name)
             tifffile.imsave(tif_name, data)
@@ -72,45 +160,80 @@ class MakeMasks3D:
         fig.suptitle('Corrected')
     
     def view_corr(self):
-        self.corr_images = []
+        if not self.corr_images:
+            with self.plane_arrays() as paths:
+                self.corr_images = get_pool().ensure().map(
+                    _registered_corr_image, [(path, self.max_shift) for path in paths])
         fig, axes = plt.subplots(1, self.planes, constrained_layout=True)
         for i,ax in enumerate(axes):
-            image = self.motion_corrected_images[i]
-            corr_im = cm.local_correlations(image, swap_dim=False)
-            self.corr_images.append(corr_im)
-            ax.imshow(image)
+            ax.imshow(self.corr_images[i])
             ax.set_aspect('equal', 'box')
             ax.axis('off')
             ax.set_title(f'Plane {i}')
         fig.suptitle('Correlation Image')
         
-    def motion_correct_red(self):
-        c, dview, n_processes = cm.cluster.setup_cluster(
-            backend='local', n_processes=None, single_thread=False)
+    def motion_correct_red(self, method='caiman'):
+        """
+        Motion corrects each plane of the template and keeps the mean corrected image.
         
+        method = 'caiman' (default) writes the planes to disk and runs caiman's MotionCorrect with
+                 the mc_opts, 'rigid' registers the frames in memory (see registration.py), which
+                 is faster but only rigid, so mc_opts asking for pw_rigid still go through caiman
+        """
         self.motion_corrected_images = []
-        for plane in list(range(self.planes)):
-            print(f'Starting motion correction plane {plane}')
-            self.mc = MotionCorrect(self.file_list[plane], dview=dview, **self.opts.get_group('motion'))
-            self.mc.motion_correct()
-            self.motion_corrected_images.append(self.mc.total_template_els)
-        cm.stop_server(dview=dview)
+        method = self._mc_method(method)
+        
+        if method == 'rigid':
+            print(f'Starting motion correction of {self.planes} planes')
+            with self.plane_arrays() as paths:
+                self.motion_corrected_images = get_pool().ensure().map(
+                    _register_plane, [(path, self.max_shift) for path in paths])
+        
+        elif method == 'caiman':
+            if not self.file_list:
+                self.save_planes()
+            dview = get_pool().ensure().dview
+            for plane in list(range(self.planes)):
+                print(f'Starting motion correction plane {plane}')
+                self.mc = MotionCorrect(self.file_list[plane], dview=dview, **self.opts.get_group('motion'))
+                self.mc.motion_correct()
+                self.motion_corrected_images.append(self.mc.total_template_els)
+        
+        else:
+            raise ValueError(f"Unknown motion correction method '{method}', use 'rigid' or 'caiman'.")
             
     def extract_masks(self, radius=7):
-        self.masks = []
-        self.coords = []
         if len(self.motion_corrected_images) > 0:
             image_source = self.motion_corrected_images
         else:
-            image_source = self.images
-        for plane in range(self.planes):
-            self.masks.append(cm.base.rois.extract_binary_masks_from_structural_channel(image_source[plane])[0])
-            self.coords.append(cm.utils.visualization.get_contours(self.masks[plane], 
-                                                                   image_source[plane].shape,
-                                                                   thr=0.99,
-                                                                   thr_method='max'))
+            image_source = [images.mean(axis=0) for images in self.images]
+        results = get_pool().ensure().map(_plane_masks, image_source)
+        self.masks = [masks for masks, _ in results]
+        self.coords = [coords for _, coords in results]
+        
+    def segment_planes(self, corr=True):
+        """
+        Runs rigid registration, mask extraction, contours and (optionally) the correlation image for
+        all planes at once, one plane per worker. Results are kept in plane order.
+        """
+        t = tic()
+        with self.plane_arrays() as paths:
+            results = get_pool().ensure().map(
+                _segment_plane, [(path, self.max_shift, corr) for path in paths])
+        self.motion_corrected_images = [r[0] for r in results]
+        self.masks = [r[1] for r in results]
+        self.coords = [r[2] for r in results]
+        self.corr_images = [r[3] for r in results] if corr else []
+        print(f'Segmented {self.planes} planes. Took {toc(t):.4f}s')
         
-    def run(self):
-        self.crop_tiffs()
-        self.motion_correct_red()
-        self.extract_masks()
\ No newline at end of file
+    def run(self, method='caiman', save=False):
+        """
+        Crops the template, motion corrects it and makes the masks. method is as in
+        motion_correct_red, 'rigid' does every step for all planes in parallel (segment_planes).
+        """
+        self.crop_tiffs(save=save)
+        if self._mc_method(method) == 'rigid':
+            self.segment_planes()
+        else:
+            self.motion_correct_red(method=method)
+            self.extract_masks()
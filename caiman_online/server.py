@@ -7,14 +7,23 @@ import asyncio
 import json
 import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
-import scipy.io as sio
+import psutil
 import websockets
 
 from .analysis import process_data, stim_align_trialwise
+from .batching import BatchSizer, PeakMemory
+from .checkpoint import CheckpointLog, compact_batch
+from .events import TrialEventStore
+from .protocol import pack_result
+from .timing import align_planes
+from .export import IncrementalMatExporter, ResultWriter, save_result, savemat_atomic
 from .wscomm import WebSocketAlert
-from .utils import cleanup
+from .utils import tic, toc
+from .workers import FitScheduler, get_pool
 
 warnings.filterwarnings(
     action='ignore',
@@ -35,55 +44,228 @@ class SISocketServer:
     port = port to serve on, defaults to 5000
     expt = online experiment object
     srv_folder = where to output .mat (doesn't have to be a server)
-    batch_size = number of tiffs to do at once
+    batch_size = number of tiffs to do at once, until there's enough info to size batches adaptively
+    memory_budget = bytes a batch is allowed to use, defaults to half of available RAM
+    target_latency = seconds a batch should take from acquisition to results, defaults to None
+    transport_dtype = dtype results are pushed to the DAQ as: float32 (default), float16, or an
+                      integer type like uint16 to quantize (see protocol.py)
+    mat_compression = HDF5 compression for the .mat files (eg. 'gzip'), defaults to None
+    checkpoint = keep a crash-safe session.ckpt in srv_folder, defaults to True
+    resume = pick up the session in srv_folder's session.ckpt instead of starting over (make expt
+             with resume=True too so its outputs aren't cleaned up), defaults to False
+    sessions = number of sessions to run back to back before the server quits, None to keep going
+               until it's stopped. Sessions after the first save to srv_folder/session_001 etc.
+               Defaults to 1.
+    start = start serving right away (blocks until the server stops), defaults to True. Otherwise
+            call run(), or await serve() from your own event loop.
     """
-    def __init__(self, ip, port, expt, srv_folder, batch_size):
+    def __init__(self, ip, port, expt, srv_folder, batch_size, memory_budget=None,
+                 target_latency=None, transport_dtype=np.float32, mat_compression=None,
+                 checkpoint=True, resume=False, sessions=1, start=True):
         self.ip = ip
         self.port = port
         self.expt = expt
         self.url = f'ws://{ip}:{port}'
+        self.base_folder = srv_folder
         self.srv_folder = srv_folder
 
+        self.batch_size = batch_size
+        self.min_frames_to_process = 500
+        self.memory_budget = memory_budget
+        self.target_latency = target_latency
+        self.transport_dtype = np.dtype(transport_dtype)
+        self.mat_compression = mat_compression
+        self.use_checkpoint = checkpoint or resume
+        self.sessions = sessions
+        self.sessions_done = 0
+        self.session_number = -1 # counts up in new_session
+
+        # DAQ clients that asked to have results pushed to them
+        # websocket -> seq of the next frame sent to it, every subscription counts from 0 so a client
+        # that subscribes late (or again after a restart) never waits on frames it wasn't sent
+        self.subscribers = {}
+        self.expt.on_preview = self.handle_preview
+
+        # set up by serve()
+        self.loop = None
+        self.stop_event = None
+        self.session_ready = None # cleared while a session is being wrapped up
+        self.fit_executor = None
+        self.scheduler = None # shared fit threads when running under a MultiSessionServer
+        self.session_id = None
+        self._previews = set()
+
+        self.writer = None
+        self.new_session(resume=resume)
+
+        if start:
+            self.run()
+
+    def new_session(self, resume=False):
+        """
+        Resets the counters, trial data and writers for a new session. The expt keeps its templates
+        and the worker pool, so there's no startup cost between sessions. The first session saves
+        to srv_folder, later ones to srv_folder/session_001 etc.
+        """
+        self.session_number += 1
+        if self.session_number > 0:
+            self.srv_folder = os.path.join(self.base_folder, f'session_{self.session_number:03}')
+            os.makedirs(self.srv_folder, exist_ok=True)
+
         self.acqs_done = 0
         self.acqs_this_batch = 0
-        self.acq_per_batch = batch_size
+        self.acq_per_batch = self.batch_size
         self.iters = 0
         self.expt.batch_size = self.acq_per_batch
-        self.min_frames_to_process = 500
+        self.sizer = BatchSizer(min_frames=self.min_frames_to_process,
+                                memory_budget=self.memory_budget,
+                                target_latency=self.target_latency)
+        if self.session_number > 0:
+            self.expt.new_session()
 
         self.trial_lengths = []
         self.traces = []
-        self.stim_times = []
-        self.stim_conds = []
-        self.vis_conds = []
+        # DAQ trial data by trial number, each batch looks up the trials of its own tiffs
+        self.events = TrialEventStore()
+        self.expt.events = self.events
 
         self.data = []
         self.task = None
+        self.batch_task = None
+        self.finalizing = False
         self.has_daq_data = False
 
-        WebSocketAlert(f'Starting WS server ({self.url})...', 'success')
-        self._start_server()
+        # all disk writes go through here so the loop never blocks on I/O
+        self.writer = ResultWriter()
+        self.expt.writer = self.writer
+        self.exporter = None # made on the first batch so an empty session doesn't clobber old files
+
+        self.checkpoint = None
+        if self.use_checkpoint:
+            self.checkpoint = CheckpointLog(os.path.join(self.srv_folder, 'session.ckpt'),
+                                            fresh=not resume)
+        if resume:
+            self.resume_session()
+
+    @property
+    def stim_times(self):
+        return self.events.stim_times
+
+    @property
+    def stim_conds(self):
+        return self.events.conditions
+
+    @property
+    def vis_conds(self):
+        return self.events.vis_conds
+
+    def run(self):
+        """
+        Runs the WS server in a new event loop until it's stopped. Blocks. Can be called again
+        afterward to keep going with the same expt and workers.
+        """
+        asyncio.run(self.serve())
 
-    def _start_server(self):
+    async def serve(self):
         """
-        Starts the WS server.
+        Serves until stop() is called or the last session ends, then shuts down cleanly: the batch
+        in progress is finished and saved and every queued write is done before this returns, even
+        if it's cancelled (eg. by ctrl-c).
         """
-        serve = websockets.serve(self.handle_incoming, self.ip, self.port)
-        asyncio.get_event_loop().run_until_complete(serve)
-        WebSocketAlert('Ready to launch!', 'success')
-        self.loop = asyncio.get_event_loop()
-        self.loop.run_forever()
+        # fits get their own thread, one at a time, instead of sharing the loop's default executor
+        self.attach(fit_executor=ThreadPoolExecutor(max_workers=1, thread_name_prefix='caiman-fit'))
+
+        WebSocketAlert(f'Starting WS server ({self.url})...', 'success')
+        try:
+            async with websockets.serve(self.handle_incoming, self.ip, self.port):
+                WebSocketAlert('Ready to launch!', 'success')
+                await self.stop_event.wait()
+        finally:
+            await self.shutdown()
 
-    async def handle_incoming(self, websocket, path):
+    def attach(self, fit_executor=None, scheduler=None, session_id=None):
+        """
+        Gets ready to handle messages on the running event loop, with fits run on fit_executor or
+        through a FitScheduler shared with other sessions.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.session_ready = asyncio.Event()
+        self.session_ready.set()
+        self.fit_executor = fit_executor
+        self.scheduler = scheduler
+        self.session_id = session_id
+        if self.writer is None:
+            self.new_session()
+
+    async def run_fit(self, func, info=None):
+        """
+        Runs func on a fit thread, taking turns with other sessions if there's a scheduler. info is
+        filled in as in FitScheduler.run.
+        """
+        if self.scheduler is not None:
+            return await self.scheduler.run(self.session_id, func, info)
+        return await self.loop.run_in_executor(self.fit_executor, func)
+
+    def _measured_fit(self, batch):
+        """Fits the next batch and returns how long it took and its peak memory. Runs on the fit
+        thread, so time spent waiting for a turn isn't counted."""
+        t = tic()
+        with PeakMemory() as mem:
+            self.expt.do_next_group(batch)
+        return toc(t), mem.used
+
+    def stop(self):
+        """Tells the server (or just this session, under a MultiSessionServer) to shut down. Safe
+        to call from any thread."""
+        if self.stop_event is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def drain(self):
+        """Waits for the batch in progress, previews being pushed and all queued writes."""
+        if self.batch_task is not None:
+            await asyncio.gather(self.batch_task, return_exceptions=True)
+        await asyncio.gather(*[asyncio.wrap_future(f) for f in list(self._previews)],
+                             return_exceptions=True)
+        await asyncio.to_thread(self.writer.flush)
+
+    async def shutdown(self):
+        """Drains everything in flight, then closes the writer and the fit thread."""
+        WebSocketAlert('Shutting down, finishing work in progress...', 'info')
+        try:
+            await self.drain()
+        finally:
+            await asyncio.to_thread(self.writer.close)
+            self.writer = None
+            if self.fit_executor is not None:
+                self.fit_executor.shutdown(wait=True)
+                self.fit_executor = None
+            WebSocketAlert('Server stopped.', 'success')
+
+    async def handle_incoming(self, websocket, path=None):
         """
         Handles data incoming over the websocket and dispatches
         to specific handle functions.
         """
 
         # async for data in websocket:
-        self.websocket = websocket
         data = await websocket.recv()
-        data = json.loads(data)
+        await self.dispatch(json.loads(data), websocket)
+
+    def _late_trial_data(self, data):
+        return (not self.session_ready.is_set() and not self.finalizing
+                and isinstance(data, dict) and data.get('kind') == 'daq_data'
+                and len(self.events) < self.acqs_done)
+
+    async def dispatch(self, data, websocket):
+        """Handles one decoded message."""
+        self.websocket = websocket
+
+        # anything for the next session waits (in order) until the last one is wrapped up, except
+        # trial data the ending session is still missing (eg. the last trial's, sent after
+        # 'session done'), which it takes as long as it hasn't been finalized
+        if data != 'subscribe' and not self._late_trial_data(data):
+            await self.session_ready.wait()
 
         if isinstance(data, dict):
             # handle the data if it's a dict
@@ -99,18 +281,24 @@ class SISocketServer:
 
             elif data == 'uhoh':
                 print('uhoh!')
-                self.loop.stop()
+                self.stop()
 
             elif data == 'hi':
                 print('SI computer says hi!')
 
+            elif data == 'subscribe':
+                # keep this connection open and push results to it until it closes
+                await self.handle_subscribe(websocket)
+
             elif data == 'wtf':
                 WebSocketAlert('BAD ERROR IN CAIMAN_MAIN (self.everything_is_ok == False)', 'error')
                 print('quitting...')
-                self.loop.stop()
+                self.stop()
 
             elif data == 'reset':
                 self.acqs_done = 0
+                # keep the same workers for the next session, just make sure they're still alive
+                get_pool().ensure()
 
             else:
                 # event not specified
@@ -122,7 +310,7 @@ class SISocketServer:
             print('unknown str data!')
             print(data)
 
-    def handle_json(self, data):
+    def handle_json(self, data, log=True):
 
         try:
             kind = data['kind']
@@ -142,24 +330,27 @@ class SISocketServer:
                 print(f'tiff source folder set to: {self.expt.folder}')
 
                 frames_per_plane = data['framesPerPlane']
-                self.acq_per_batch = self.min_frames_to_process // int(frames_per_plane)
+                self.sizer.configure(frames_per_plane, self.plane_dims, fr=self.expt.opts.data['fr'])
+                self.acq_per_batch = self.sizer.tiffs_per_batch()
                 self.expt.batch_size  = self.acq_per_batch
                 print(f'tiffs per batch set to: {self.expt.batch_size}')
 
                 self.expt._verify_folder_structure()
+                self.expt.configured = True
 
             elif kind == 'daq_data':
                 WebSocketAlert('Recieved trial data from DAQ', 'success')
-                # appends in a trialwise manner
-                self.stim_conds.append(data['condition'])
-                self.stim_times.append(data['stim_times'])
-                self.vis_conds.append(data['vis_cond'])
-                # print(self.stim_conds)
+                # trials are numbered in the order they come unless the DAQ says which one it is
+                self.events.append(data['condition'], data['stim_times'], data['vis_cond'],
+                                   trial=data.get('trial'))
                 self.has_daq_data = True
 
             else:
                 raise KeyError
 
+            if log and self.checkpoint is not None:
+                self.writer.submit(self.checkpoint.append, 'message', data)
+
         except KeyError:
             WebSocketAlert('Unknown JSON data. Printing data below...', 'error')
             print(data)
@@ -176,27 +367,36 @@ class SISocketServer:
         if self.acqs_this_batch >= self.acq_per_batch:
             self.acqs_this_batch = 0
             self.iters += 1
-            self.expt.times = self.stim_conds[:self.acq_per_batch]
-            self.expt.cond = self.stim_times[:self.acq_per_batch]
-            self.expt.vis_cond = self.vis_conds[:self.acq_per_batch]
+            # the batch's trial data is looked up from self.events by the tiffs it actually uses
 
-            WebSocketAlert('Starting caiman fit', 'info')
-            
-            # run the group in another thread and wait for the result
-            self.task = self.loop.run_in_executor(None, self.expt.do_next_group)
-            await self.task
+            # its own task, so the batch is still finished and saved if this connection goes away
+            # or the server is shut down while it's running
+            self.batch_task = asyncio.ensure_future(self.run_batch(self.iters, self.batch_task))
+            await asyncio.shield(self.batch_task)
 
-            WebSocketAlert('Fit done. Waiting on next batch', 'success')
+    async def run_batch(self, batch, previous=None):
+        """
+        Fits the next batch on the fit thread, then saves and pushes the results. Waits for the
+        previous batch first so batches always finish in order.
+        """
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
 
-            # save the data
-            self.data.append(self.expt.data_this_round)
-            try:
-                self.expt.save_json(path=self.server_folder)
-            except:
-                print('problem saving the json!')
+        WebSocketAlert('Starting caiman fit', 'info')
+        info = {}
+        self.task = asyncio.ensure_future(self.run_fit(partial(self._measured_fit, batch), info))
+        fit_time, mem_used = await self.task
+        # memory is process-wide, it doesn't say anything about this fit if another ran alongside
+        self.resize_batch(fit_time, None if info.get('shared') else mem_used)
+
+        WebSocketAlert('Fit done. Waiting on next batch', 'success')
 
-            # if self.has_daq_data == True:
-            #     await self.handle_outgoing(self.data)
+        # save the data (queued on the writer, doesn't block)
+        self.data.append(self.expt.data_this_round)
+        self.export_batch(self.expt.data_this_round, self.expt.batch_fnumber)
+        self.save_checkpoint(self.expt.data_this_round)
+
+        await self.push_results(self.expt.data_this_round, batch)
 
     async def handle_session_end(self):
         """
@@ -207,35 +407,185 @@ class SISocketServer:
         making sure there are enough tiffs for the final fit.
         """
         WebSocketAlert('SI says session ended.', 'warn')
-        
-        if self.iters == 0:
-            self.loop.stop()
-        else:
+        self.session_ready.clear()
+        try:
+            await self.end_session()
+        finally:
+            self.session_ready.set()
+
+    async def end_session(self):
+        """Finishes and saves the current session, then quits or gets ready for the next one."""
+        if self.iters > 0:
             WebSocketAlert('Waiting for Caiman to finish.', 'info')
-            await self.task
+            if self.batch_task is not None:
+                await asyncio.shield(self.batch_task)
             
             self.update()
             
             WebSocketAlert('Proccessing final data...', 'info')
-            self.save_trial_data_mat()
-            
-            WebSocketAlert('Data saved. Quitting...', 'success')
-            self.loop.stop()
-            
-            try:
-                cleanup(os.getcwd()+'/', 'npz')
-                cleanup(self.expt.folder, 'mmap')
-            except:
-                WebSocketAlert('Not able to clean everything up bc a file was in use probably.', 'warn')
+            self.finalizing = True
+            # batches are already on disk, queued behind any writes still pending
+            await asyncio.wrap_future(self.writer.submit(self.finalize_mat))
+            WebSocketAlert('Data saved.', 'success')
             
+            # deleted in the background once nothing has them mapped
+            self.expt.movie = None
+            self.expt.janitor.delete_kind('mmap')
+        
+        self.sessions_done += 1
+        if self.sessions is not None and self.sessions_done >= self.sessions:
+            WebSocketAlert('Quitting...', 'success')
+            self.stop()
             print('bye!')
+        else:
+            # same server, expt and workers, new outputs
+            writer = self.writer
+            self.new_session()
+            await asyncio.to_thread(writer.close)
+            WebSocketAlert(f'Ready for the next session, saving to {self.srv_folder}', 'success')
 
-    async def handle_outgoing(self, data):
-        out = json.dumps(data)
-        await self.websocket.send(out)
+    async def handle_subscribe(self, websocket):
+        """
+        Registers a DAQ client to get results pushed to it, and holds the connection open until the
+        client goes away.
+        """
+        WebSocketAlert('DAQ subscribed to caiman results', 'success')
+        self.subscribers[websocket] = 0
+        try:
+            await websocket.wait_closed()
+        finally:
+            self.subscribers.pop(websocket, None)
+            WebSocketAlert('DAQ unsubscribed', 'warn')
+
+    def handle_preview(self, previews, batch):
+        """
+        Called from the fit thread when the fast preview for a batch is done (see
+        OnlineAnalysis.do_preview). Pushes it to the DAQ while the full fit keeps going. batch is
+        the number of the batch being fit, self.iters may already be on the next one.
+        """
+        WebSocketAlert('Preview ready, sending to DAQ', 'info')
+        future = asyncio.run_coroutine_threadsafe(
+            self.push_results(previews, batch, preview=True), self.loop)
+        # kept until sent so shutdown can wait on it
+        self._previews.add(future)
+        future.add_done_callback(self._previews.discard)
+
+    async def push_results(self, batch_data, batch, preview=False):
+        """
+        Sends just the new batch to subscribed clients as binary frames (see protocol.py), one per
+        plane, so message size doesn't grow over the session. Frames are numbered per subscriber.
+
+        Args:
+            batch_data (list): json data for each plane, from expt.data_this_round
+            batch (int): batch number
+            preview (bool, optional): whether these are preview results that the full fit for the
+                                      same batch will replace. Defaults to False.
+        """
+        if not self.subscribers:
+            return
+
+        planes = []
+        for plane, plane_data in enumerate(batch_data):
+            coords = json.loads(plane_data['coords'])['CoM']
+            planes.append((
+                {'c': plane_data['c'], 'dff': plane_data['dff']},
+                dict(
+                    kind='cm_result',
+                    batch=batch,
+                    plane=plane,
+                    nplanes=len(batch_data),
+                    fr=plane_data.get('fr', self.expt.opts.data['fr']),
+                    preview=preview,
+                    splits=plane_data['splits'],
+                    cond=plane_data['cond'],
+                    vis_cond=plane_data['vis_cond'],
+                    com=[coords[k] for k in sorted(coords, key=int)],
+                    frame_times=(None if plane_data.get('frame_times') is None
+                                 else np.round(plane_data['frame_times'], 5).tolist()),
+                ),
+            ))
+
+        for websocket in list(self.subscribers):
+            try:
+                for arrays, meta in planes:
+                    if websocket not in self.subscribers:
+                        break
+                    # numbered before the send, another push can run while this one waits
+                    seq = self.subscribers[websocket]
+                    self.subscribers[websocket] = seq + 1
+                    await websocket.send(pack_result(seq, arrays, dtype=self.transport_dtype, **meta))
+            except websockets.ConnectionClosed:
+                self.subscribers.pop(websocket, None)
         WebSocketAlert('Sent Caiman Data to DAQ', 'info')
 
 
+    @property
+    def plane_dims(self):
+        """Size of each plane after cropping."""
+        return (512, self.expt.x_end - self.expt.x_start)
+
+    def resize_batch(self, fit_time, mem_used):
+        """
+        Feeds the last batch's fit time and memory to the batch sizer and sets the number of tiffs
+        for the next batch.
+        """
+        splits = self.expt.data_this_round[0]['splits']
+        frames = sum(splits)
+        if self.sizer.frames_per_tiff is None:
+            # no setup message, go off of the tiffs we've seen
+            self.sizer.configure(frames // max(len(splits), 1), self.plane_dims,
+                                 fr=self.expt.opts.data['fr'])
+        self.sizer.observe(frames, fit_time, mem_used)
+
+        new_size = self.sizer.tiffs_per_batch()
+        if new_size != self.acq_per_batch:
+            WebSocketAlert(f'Batch size changed from {self.acq_per_batch} to {new_size} tiffs', 'info')
+        self.acq_per_batch = new_size
+        self.expt.batch_size = new_size
+
+    def save_checkpoint(self, batch_data):
+        """Queues a checkpoint record for a finished batch, with everything needed to resume."""
+        if self.checkpoint is None:
+            return
+        state = {
+            'iters': self.iters,
+            'acqs_done': self.acqs_done,
+            'acq_per_batch': self.acq_per_batch,
+            'sizer': dict(vars(self.sizer)),
+            'expt': self.expt.checkpoint_state(),
+        }
+        self.writer.submit(self.checkpoint.append, 'batch',
+                           {'data': compact_batch(batch_data), 'state': state})
+
+    def resume_session(self):
+        """
+        Restores the session from the checkpoint log: replays the setup and trial messages, reloads
+        every finished batch (and rebuilds the .mat files from them), and restores the counters so
+        the next batch starts with the tiffs that weren't processed yet.
+        """
+        session = self.checkpoint.replay()
+        for message in session['messages']:
+            self.handle_json(message, log=False)
+
+        for batch_data in session['batches']:
+            self.data.append(batch_data)
+            self.writer.submit(self.export_mat_batch, batch_data)
+
+        state = session['state']
+        if state:
+            self.iters = state['iters']
+            self.acqs_done = state['acqs_done']
+            self.acq_per_batch = state['acq_per_batch']
+            self.sizer.__dict__.update(state['sizer'])
+            self.expt.restore_state(state['expt'])
+            for batch_data in session['batches']:
+                self.expt.record_frame_times(batch_data)
+        self.expt.batch_size = self.acq_per_batch
+        self.acqs_this_batch = len(self.expt.unprocessed_tiffs)
+
+        WebSocketAlert(f'Resumed session after batch {self.iters} ({len(self.events)} trials, '
+                       f'{self.acqs_this_batch} tiffs waiting)', 'success')
+
     def update(self):
         """
         Updates acq counters and anything else that needs to keep track of trial counts.
@@ -246,6 +596,41 @@ class SISocketServer:
     def format_out_data(self):
         pass
 
+    def export_batch(self, batch_data, fnumber):
+        """
+        Queues the json for each plane of a finished batch to be written to srv_folder.
+
+        Args:
+            batch_data (list): json data for each plane, from expt.data_this_round
+            fnumber (int): file number of the batch, used for the file names
+        """
+        for plane, plane_data in enumerate(batch_data):
+            fname = f'data_out_plane{plane}_{fnumber:04}.json'
+            self.writer.submit(save_result, os.path.join(self.srv_folder, fname), plane_data,
+                               self.expt.sidecar, dtype=self.expt.dtype)
+        self.writer.submit(self.export_mat_batch, batch_data)
+
+    def export_mat_batch(self, batch_data):
+        """Appends a batch to the session .mat files. Runs on the writer thread."""
+        if self.exporter is None:
+            # MATLAB has no float16, so anything below double is saved as single
+            dtype = np.float64 if self.expt.dtype == np.float64 else np.float32
+            self.exporter = IncrementalMatExporter(self.srv_folder, dtype=dtype,
+                                                   compression=self.mat_compression)
+        self.exporter.append_batch(batch_data)
+
+    def finalize_mat(self):
+        """
+        Adds the trial data to the incrementally saved .mat files and closes them. Runs on the
+        writer thread. Use save_trial_data_mat to rebuild them from self.data instead.
+        """
+        if self.exporter is None:
+            WebSocketAlert('No batches to save.', 'warn')
+            return
+        self.exporter.finalize(self.stim_times, self.stim_conds, self.vis_conds,
+                               has_daq_data=self.has_daq_data)
+        self.exporter = None
+
     def save_trial_data_mat(self):
         
         dff_data = []
@@ -254,9 +639,15 @@ class SISocketServer:
         loc_data = []
         
         for acq in self.data:
-            fewest_frames = min([np.array(plane['c']).shape[1] for plane in acq])
-            fit_data.append(np.concatenate([np.array(plane['c'])[:,:fewest_frames] for plane in acq]))
-            dff_data.append(np.concatenate([np.array(plane['dff'])[:,:fewest_frames] for plane in acq]))
+            frame_times = [plane.get('frame_times') for plane in acq]
+            if all(t is not None for t in frame_times):
+                # line the planes up on plane 0's frame times instead of cutting frames
+                fit_data.append(align_planes([plane['c'] for plane in acq], frame_times)[0])
+                dff_data.append(align_planes([plane['dff'] for plane in acq], frame_times)[0])
+            else:
+                fewest_frames = min([np.asarray(plane['c']).shape[1] for plane in acq])
+                fit_data.append(np.concatenate([np.asarray(plane['c'])[:,:fewest_frames] for plane in acq]))
+                dff_data.append(np.concatenate([np.asarray(plane['dff'])[:,:fewest_frames] for plane in acq]))
             
             len_data.append(np.array(acq[0]['splits']))
     
@@ -265,8 +656,9 @@ class SISocketServer:
             loc_data.append(np.array(list(coords.values())))
             
         len_data = np.concatenate(len_data)
-        fit_data = np.concatenate(fit_data, axis=1)
-        dff_data = np.concatenate(dff_data, axis=1)
+        # at least single precision, .mat files can't hold float16
+        fit_data = np.concatenate(fit_data, axis=1).astype(np.result_type(fit_data[0], np.float32))
+        dff_data = np.concatenate(dff_data, axis=1).astype(np.result_type(dff_data[0], np.float32))
 
         # save whole trace output as mat file
         out_data = fit_data - fit_data.min(axis=1).reshape(-1,1)
@@ -279,7 +671,7 @@ class SISocketServer:
         }
         
         save_path = os.path.join(self.srv_folder, f'caiman_traces_full.mat')
-        sio.savemat(save_path, out)
+        savemat_atomic(save_path, out)
 
         # make into psths and save
         psths = process_data(fit_data, len_data)
@@ -292,7 +684,7 @@ class SISocketServer:
         }
         
         save_path = os.path.join(self.srv_folder, f'caiman_psths.mat')
-        sio.savemat(save_path, out)
+        savemat_atomic(save_path, out)
         
         # if stim aligned, save it
         if self.has_daq_data:
@@ -305,4 +697,146 @@ class SISocketServer:
             }
             
             save_path = os.path.join(self.srv_folder, f'caiman_psths_aligned.mat')
-            sio.savemat(save_path, out)
\ No newline at end of file
+            savemat_atomic(save_path, out)
+
+class MultiSessionServer:
+    """
+    Serves several sessions at once (eg. one per rig) on one websocket port. Every message carries
+    the ID of the session it's for (see networking.py), and each session is its own SISocketServer
+    with its own expt, counters, trial data, outputs and subscribers. Fits from every session go
+    through a FitScheduler, which takes turns between sessions.
+
+    ip = IP address to serve on
+    port = port to serve on
+    fit_slots = fits that can run at once across all sessions, defaults to 1
+    memory_budget = bytes all sessions' batches may use together, split evenly between the sessions
+                    that weren't given their own. Defaults to half of the available RAM.
+    """
+    def __init__(self, ip, port, fit_slots=1, memory_budget=None):
+        self.ip = ip
+        self.port = port
+        self.url = f'ws://{ip}:{port}'
+        self.fit_slots = fit_slots
+        self.memory_budget = memory_budget
+
+        self.sessions = {} # session ID -> SISocketServer
+        self._shared_budget = set() # sessions that get a share of memory_budget
+        self.scheduler = None
+        self.loop = None
+        self.stop_event = None
+
+    def add_session(self, session_id, expt, srv_folder, batch_size, **kwargs):
+        """
+        Adds a session. Rigs send their messages with this session ID.
+
+        Args:
+            session_id (str): ID the rig sends with its messages
+            expt (OnlineAnalysis): the session's experiment, with its own tiff folder
+            srv_folder (str): where this session's outputs go, can't be shared with another session
+            batch_size (int): starting number of tiffs per batch
+            **kwargs: passed on to SISocketServer. By default each session runs sessions back to
+                      back until the server is stopped (sessions=None).
+
+        Returns:
+            SISocketServer: the session
+        """
+        session_id = str(session_id)
+        if session_id in self.sessions:
+            raise ValueError(f'There is already a session called {session_id}.')
+        for other in self.sessions.values():
+            if os.path.abspath(other.base_folder) == os.path.abspath(srv_folder):
+                raise ValueError(f'{srv_folder} is already used by another session.')
+            if other.expt is expt:
+                raise ValueError('Every session needs its own OnlineAnalysis.')
+
+        kwargs.setdefault('sessions', None)
+        if kwargs.get('memory_budget') is None:
+            self._shared_budget.add(session_id)
+        session = SISocketServer(self.ip, self.port, expt, srv_folder, batch_size, start=False,
+                                 **kwargs)
+        self.sessions[session_id] = session
+        return session
+
+    def _share_resources(self):
+        """Splits the memory budget between the sessions."""
+        if self._shared_budget:
+            total = self.memory_budget
+            if total is None:
+                total = psutil.virtual_memory().available // 2
+            share = total // len(self._shared_budget)
+            for session_id in self._shared_budget:
+                session = self.sessions[session_id]
+                session.memory_budget = share
+                session.sizer.memory_budget = share
+
+    def run(self):
+        """Runs the server in a new event loop until it's stopped or every session has stopped."""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """
+        Serves every session until stop() is called or they've all stopped, then shuts each one
+        down cleanly (see SISocketServer.serve).
+        """
+        if not self.sessions:
+            raise ValueError('No sessions to serve, add them with add_session first.')
+
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.scheduler = FitScheduler(self.fit_slots)
+        self._share_resources()
+        for session_id, session in self.sessions.items():
+            session.attach(scheduler=self.scheduler, session_id=session_id)
+
+        WebSocketAlert(f'Starting WS server ({self.url}) for sessions '
+                       f'{", ".join(self.sessions)}...', 'success')
+        try:
+            async with websockets.serve(self.handle_incoming, self.ip, self.port):
+                WebSocketAlert('Ready to launch!', 'success')
+                stopped = asyncio.ensure_future(self.stop_event.wait())
+                all_done = asyncio.ensure_future(self._all_stopped())
+                try:
+                    await asyncio.wait([stopped, all_done], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    stopped.cancel()
+                    all_done.cancel()
+        finally:
+            await asyncio.gather(*[session.shutdown() for session in self.sessions.values()],
+                                 return_exceptions=True)
+            await asyncio.to_thread(self.scheduler.close)
+            WebSocketAlert(f'Fits run per session: {self.scheduler.fits_done}', 'info')
+            self.scheduler = None
+
+    async def _all_stopped(self):
+        for session in self.sessions.values():
+            await session.stop_event.wait()
+
+    def stop(self):
+        """Tells the server to shut down every session. Safe to call from any thread."""
+        if self.stop_event is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def route(self, data):
+        """
+        Splits a message into its session ID and the message itself. Messages without an ID go to
+        the only session, if there is just one.
+        """
+        if isinstance(data, dict) and 'session' in data and 'message' in data:
+            return str(data['session']), data['message']
+        if len(self.sessions) == 1:
+            return next(iter(self.sessions)), data
+        return None, data
+
+    async def handle_incoming(self, websocket, path=None):
+        """Hands each incoming message to the session it's for."""
+        data = json.loads(await websocket.recv())
+        session_id, data = self.route(data)
+
+        session = self.sessions.get(session_id)
+        if session is None:
+            WebSocketAlert(f'Message for unknown session {session_id}. Printing data below...', 'error')
+            print(data)
+        elif session.stop_event.is_set():
+            WebSocketAlert(f'Session {session_id} has stopped, ignoring message.', 'warn')
+        else:
+            await session.dispatch(data, websocket)
@@ -1,5 +1,6 @@
 import numpy as np
 import scipy
+import scipy.stats
 
 def ci(data, confidence=0.95):
     """
@@ -23,7 +24,63 @@ def ci(data, confidence=0.95):
     low = mean - h
     return low, high
 
-def traces_ci(traces, *args, **kwargs):
-    """Does CI for a time series."""
-    func = lambda x: ci(x, *args, **kwargs)
-    return np.apply_along_axis(func, 0, traces)
\ No newline at end of file
+def ci_along(data, axis=0, confidence=0.95):
+    """
+    Vectorized version of ci. Calculates t-distribution confidence intervals along an axis of an
+    N-D array all at once, so (for example) every timepoint of every cell/condition is done in
+    one go instead of one call per column.
+
+    Args:
+        data (array-like): N-D array of input data
+        axis (int, optional): axis holding the samples. Defaults to 0.
+        confidence (float, optional): CI bounds to use. Defaults to 0.95.
+
+    Returns:
+        array of low and high CI bounds, shape (2, *data.shape without axis)
+    """
+    data = np.asarray(data)
+    n = data.shape[axis]
+    mean = data.mean(axis=axis)
+    err = data.std(axis=axis, ddof=1) / np.sqrt(n)
+    h = err * scipy.stats.t.ppf((1+confidence)/2, n-1)
+    return np.stack([mean - h, mean + h])
+
+def bootstrap_ci(data, axis=0, confidence=0.95, n_boot=1000, seed=0):
+    """
+    Bootstrapped confidence intervals of the mean along an axis of an N-D array. All resamples
+    are done at once by counting how many times each sample is drawn and taking one matrix
+    product against the data, rather than indexing out every resample.
+
+    Args:
+        data (array-like): N-D array of input data
+        axis (int, optional): axis holding the samples. Defaults to 0.
+        confidence (float, optional): CI bounds to use. Defaults to 0.95.
+        n_boot (int, optional): number of resamples. Defaults to 1000.
+        seed (int, optional): seed for the RNG so results are repeatable. Defaults to 0.
+
+    Returns:
+        array of low and high CI bounds, shape (2, *data.shape without axis)
+    """
+    data = np.moveaxis(np.asarray(data), axis, 0)
+    n = data.shape[0]
+    rest = data.shape[1:]
+
+    rng = np.random.default_rng(seed)
+    draws = rng.integers(0, n, size=(n_boot, n))
+    # counts[b, i] is how many times sample i was drawn in resample b
+    counts = np.zeros((n_boot, n))
+    np.add.at(counts, (np.arange(n_boot)[:, None], draws), 1)
+
+    boot_means = counts @ data.reshape(n, -1) / n
+    alpha = (1 - confidence) / 2
+    bounds = np.quantile(boot_means, [alpha, 1 - alpha], axis=0)
+    return bounds.reshape((2,) + rest)
+
+def traces_ci(traces, *args, method='t', **kwargs):
+    """
+    Does CI for a time series (or a stack of them), with the samples on axis 0. Method can be 't'
+    (see ci_along) or 'bootstrap' (see bootstrap_ci). Args and kwargs are passed to those.
+    """
+    if method == 'bootstrap':
+        return bootstrap_ci(traces, 0, *args, **kwargs)
+    return ci_along(traces, 0, *args, **kwargs)
@@ -0,0 +1,198 @@
+"""
+Frame timing. A FrameIndex is built from the ScanImage per-frame headers as tiffs are memory mapped
+and says, for every frame that went into each plane's movie, which tiff it came from, where it was
+in that tiff and when it was acquired. Traces from different planes (which aren't acquired at the
+same time, and don't always have the same number of frames) are then lined up by interpolating onto
+one time base, instead of cutting every plane down to the fewest frames.
+"""
+
+import re
+
+import numpy as np
+from ScanImageTiffReader import ScanImageTiffReader
+
+_timestamp_re = re.compile(r'frameTimestamps_sec\s*=\s*([-+\d.eE]+)')
+
+
+def _read_times(reader, n_frames):
+    """Per-frame timestamps from the frame headers, or None if they're missing."""
+    try:
+        descriptions = [reader.description(i) for i in range(n_frames)]
+    except Exception:
+        return None
+    text = '\n'.join(descriptions)
+    times = _timestamp_re.findall(text)
+    if len(times) != n_frames:
+        return None
+    return np.array(times, dtype=np.float64)
+
+
+class FrameIndex:
+    """
+    Columnar index of frames, one entry per frame per plane (in the order they are in the plane's
+    movie).
+
+    plane = plane of each frame
+    tiff = which tiff (position in the list it was built from) the frame came from
+    frame = frame number within that tiff
+    t = acquisition time in seconds
+    """
+    def __init__(self, plane, tiff, frame, t):
+        self.plane = np.asarray(plane, dtype=np.int32)
+        self.tiff = np.asarray(tiff, dtype=np.int32)
+        self.frame = np.asarray(frame, dtype=np.int64)
+        self.t = np.asarray(t, dtype=np.float64)
+
+    def __len__(self):
+        return self.t.size
+
+    @classmethod
+    def from_tiffs(cls, files, channels, planes, fr=None):
+        """
+        Builds the index for a batch of tiffs, using the same frames as OnlineAnalysis.make_mmap.
+        Only reads the frame headers, not the image data. Tiffs without per-frame timestamps get
+        times from the frame rate instead.
+
+        Args:
+            files (list): tiffs, in the order they're memory mapped
+            channels (int): channels saved
+            planes (int): planes acquired
+            fr (float, optional): frame rate of each plane, for tiffs without timestamps
+
+        Returns:
+            FrameIndex
+        """
+        stride = channels * planes
+        columns = {'plane': [], 'tiff': [], 'frame': [], 't': []}
+
+        last_t = None
+        for i, f in enumerate(files):
+            with ScanImageTiffReader(f) as reader:
+                n_frames = reader.shape()[0]
+                times = _read_times(reader, n_frames)
+            if times is None:
+                # no headers, space the imaging frames (all channels of a plane at once) evenly
+                rate = fr * planes if fr else np.nan
+                times = np.arange(n_frames) // channels / rate
+            if n_frames == 0:
+                continue
+            if last_t is not None and times[0] <= last_t:
+                # clock restarted with this tiff, carry on from the last one so time keeps going up
+                dt = np.median(np.diff(np.unique(times))) if n_frames > channels else 0
+                times = times + (last_t - times[0] + dt)
+            last_t = times[-1]
+
+            for plane in range(planes):
+                frames = np.arange(n_frames)[plane * channels:-1:stride]
+                columns['plane'].append(np.full(frames.size, plane))
+                columns['tiff'].append(np.full(frames.size, i))
+                columns['frame'].append(frames)
+                columns['t'].append(times[frames])
+
+        index = cls(**{k: np.concatenate(v) if v else [] for k, v in columns.items()})
+        # plane-major, tiffs in order within each plane, like the memmaps
+        order = np.lexsort((index.frame, index.tiff, index.plane))
+        return index.take(order)
+
+    def take(self, idx):
+        return FrameIndex(self.plane[idx], self.tiff[idx], self.frame[idx], self.t[idx])
+
+    def for_plane(self, plane):
+        """The frames of one plane, in movie order."""
+        return self.take(self.plane == plane)
+
+    @property
+    def splits(self):
+        """Frames from each tiff (for a single plane), like OnlineAnalysis.splits."""
+        return np.bincount(self.tiff, minlength=self.tiff.max() + 1 if len(self) else 0).tolist()
+
+
+def interp_rows(traces, times, new_times):
+    """
+    Linearly interpolates every row of traces (cells x time, sampled at times) onto new_times with
+    a single gather. Times outside the samples are clamped to the first/last frame.
+
+    Returns:
+        cells x len(new_times) float32 array
+    """
+    traces = np.asarray(traces)
+    times = np.asarray(times, dtype=np.float64)[:traces.shape[1]]
+    new_times = np.asarray(new_times, dtype=np.float64)
+    if times.size < 2:
+        return np.repeat(traces[:, :1], new_times.size, axis=1).astype(np.float32)
+
+    left = np.clip(np.searchsorted(times, new_times, side='right') - 1, 0, times.size - 2)
+    span = times[left + 1] - times[left]
+    span[span == 0] = 1
+    w = np.clip((new_times - times[left]) / span, 0, 1).astype(np.float32)
+    return traces[:, left] * (1 - w) + traces[:, left + 1] * w
+
+
+def resample_trials(traces, fr, new_fr):
+    """
+    Resamples trialwise traces (trial x cell x time, sampled at fr) to new_fr, keeping the same
+    span of time from each trial's start.
+
+    Returns:
+        trial x cell x time float32 array
+    """
+    traces = np.asarray(traces)
+    n_frames = traces.shape[2]
+    new_frames = max(1, int(round(n_frames * new_fr / fr)))
+    rows = traces.reshape(-1, n_frames)
+    out = interp_rows(rows, np.arange(n_frames) / fr, np.arange(new_frames) / new_fr)
+    return out.reshape(traces.shape[:2] + (new_frames,))
+
+
+def align_planes(traces, times, ref=0):
+    """
+    Puts every plane's traces on the time base of one reference plane.
+
+    Args:
+        traces (list): cells x time traces for each plane
+        times (list): frame times for each plane
+        ref (int, optional): plane whose frame times are used. Defaults to 0.
+
+    Returns:
+        all cells x time float32 array (planes stacked in order)
+        the times of each column
+    """
+    ref_times = np.asarray(times[ref], dtype=np.float64)
+    ncells = [np.shape(c)[0] for c in traces]
+    out = np.empty((sum(ncells), ref_times.size), dtype=np.float32)
+
+    row = 0
+    for plane, (c, t) in enumerate(zip(traces, times)):
+        if plane == ref:
+            out[row:row + ncells[plane]] = np.asarray(c)[:, :ref_times.size]
+        else:
+            out[row:row + ncells[plane]] = interp_rows(c, t, ref_times)
+        row += ncells[plane]
+
+    return out, ref_times
+
+
+def trialwise_by_time(traces, times, trial_starts, fr, length=None):
+    """
+    Cuts traces into trials on a common time base relative to each trial's start, so every trial
+    has the same number of samples without dropping or padding frames.
+
+    Args:
+        traces (array): cells x time
+        times (array): time of each frame
+        trial_starts (array): start time of each trial
+        fr (float): sample rate of the output
+        length (int, optional): samples per trial. Defaults to as many as fit in the shortest trial.
+
+    Returns:
+        trial x cell x time float32 array
+    """
+    times = np.asarray(times, dtype=np.float64)
+    trial_starts = np.asarray(trial_starts, dtype=np.float64)
+    if length is None:
+        ends = np.append(trial_starts[1:], times[-1] + 1 / fr)
+        length = max(1, int(np.floor(np.min(ends - trial_starts) * fr)))
+
+    sample_times = trial_starts[:, None] + np.arange(length) / fr # trial x time
+    out = interp_rows(traces, times, sample_times.ravel()) # cell x (trial*time)
+    return out.reshape(-1, trial_starts.size, length).transpose(1, 0, 2)
@@ -10,6 +10,8 @@ import os
 from ScanImageTiffReader import ScanImageTiffReader
 import tifffile
 
+from .metadata import read_metadata
+
 def mm3d_to_img(path, chan=0):
     """
     Gets the img data from a makeMasks3D file and flips it into a (512,512,z-depth) ndarray.
@@ -109,22 +111,10 @@ def crop_and_save_multiplane(mov_path, x_slice, n_planes, n_chans):
             tifffile.imsave(tif_name, cropped_mov)
             
 def get_nchannels(file):
-    with ScanImageTiffReader(file) as reader:
-        metadata = reader.metadata()
-    channel_pass_1 = metadata.split('channelSave = [')
-    if len(channel_pass_1)==1:
-        nchannels = 1
-    else:
-        nchannels = len(metadata.split('channelSave = [')[1].split(']')[0].split(';'))
-    return nchannels
+    return read_metadata(file).nchannels
 
 def get_nvols(file):
-    with ScanImageTiffReader(file) as reader:
-        metadata = reader.metadata()
-    if metadata.split('hStackManager.zs = ')[1][0]=='0':
-        return 1
-    nvols = len(metadata.split('hStackManager.zs = [')[1].split(']')[0].split(' '))
-    return nvols
+    return read_metadata(file).nplanes
 
 def random_view(arr, length, n=1):
     """
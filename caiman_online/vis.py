@@ -225,4 +225,183 @@ def _vis_resp_anova(data):
         samples = [col for col_name, col in temp4.groupby('ori')['df']]
         f_val[cell], p_val[cell] = stats.f_oneway(*samples)
 
-    return p_val
\ No newline at end of file
+    return p_val
+
+class IncrementalTuning:
+    """
+    Keeps running per-cell, per-condition stats (Welford) of baseline-subtracted responses so
+    tuning can be updated as trials come in, without redoing the whole dataframe pipeline. Gives
+    the same measures as run_pipeline: ANOVA p-values, vis_resp, pref, ortho, pdir and OSI.
+
+    analysis_window = (base start, base stop, resp start, resp stop), same as meanby
+    fr = frame rate, if given the window is in seconds, otherwise in frames
+    blank = condition value of the gray screen/blank trials, defaults to -45
+    p = p-value cut off for vis_resp
+    """
+    def __init__(self, analysis_window, fr=None, blank=-45, p=0.05):
+        assert len(analysis_window) == 4, 'Must give 4 numbers for window.'
+        self.analysis_window = analysis_window
+        self.fr = fr
+        self.blank = blank
+        self.p = p
+
+        self.conds = np.array([])
+        self.n = np.zeros(0) # trials per condition
+        self.mean = None # cells x conds
+        self.m2 = None # cells x conds, sum of squared differences from the mean
+        self.min_resp = None # min non-blank trial response for each cell, for OSI
+        self.trace_sum = None # conds x cells x time, for mean traces
+        self.trials = 0
+
+    def _window_mask(self, n_frames, start, stop):
+        t = np.arange(n_frames, dtype=float)
+        if self.fr is not None:
+            t = t / self.fr
+        return (t > start) & (t < stop)
+
+    def responses(self, traces):
+        """Baseline subtracted mean response of each trial. Returns trials x cells."""
+        b0, b1, r0, r1 = self.analysis_window
+        base = traces[:, :, self._window_mask(traces.shape[2], b0, b1)].mean(axis=2)
+        resp = traces[:, :, self._window_mask(traces.shape[2], r0, r1)].mean(axis=2)
+        return resp - base
+
+    def _trim_cells(self, ncells):
+        if self.mean is None or self.mean.shape[0] == ncells:
+            return ncells
+        ncells = min(ncells, self.mean.shape[0])
+        print(f'WARNING cell count changed, keeping {ncells} cells.')
+        self.mean = self.mean[:ncells]
+        self.m2 = self.m2[:ncells]
+        self.min_resp = self.min_resp[:ncells]
+        self.trace_sum = self.trace_sum[:, :ncells]
+        return ncells
+
+    def _add_conds(self, new_conds, ncells, nframes):
+        new_conds = np.setdiff1d(new_conds, self.conds)
+        if self.mean is None:
+            self.mean = np.zeros((ncells, 0))
+            self.m2 = np.zeros((ncells, 0))
+            self.min_resp = np.full(ncells, np.inf)
+            self.trace_sum = np.zeros((0, ncells, nframes))
+        if new_conds.size == 0:
+            return
+        k = new_conds.size
+        self.conds = np.concatenate([self.conds, new_conds])
+        self.n = np.concatenate([self.n, np.zeros(k)])
+        self.mean = np.concatenate([self.mean, np.zeros((self.mean.shape[0], k))], axis=1)
+        self.m2 = np.concatenate([self.m2, np.zeros((self.m2.shape[0], k))], axis=1)
+        self.trace_sum = np.concatenate(
+            [self.trace_sum, np.zeros((k,) + self.trace_sum.shape[1:])], axis=0)
+
+    def add_trials(self, traces, conds):
+        """
+        Adds new trials to the running stats. Cost only depends on the number of new trials.
+
+        Args:
+            traces (array): trials x cells x time, eg. from process_data
+            conds (array-like): condition (eg. orientation) of each trial
+        """
+        traces = np.asarray(traces)
+        conds = np.asarray(conds, dtype=float)
+        assert traces.shape[0] == conds.size, 'Need a condition for every trial.'
+
+        ncells = self._trim_cells(traces.shape[1])
+        traces = traces[:, :ncells]
+        self._add_conds(np.unique(conds), ncells, traces.shape[2])
+
+        # mean traces get trimmed to the shortest trial seen
+        nframes = min(self.trace_sum.shape[2], traces.shape[2])
+        self.trace_sum = self.trace_sum[:, :, :nframes]
+
+        resp = self.responses(traces)
+        idx = np.searchsorted(self.conds, conds, sorter=np.argsort(self.conds))
+        idx = np.argsort(self.conds)[idx]
+
+        # merge batch stats into the running stats (Chan et al. parallel Welford)
+        for i in np.unique(idx):
+            these = resp[idx == i]
+            n_b = these.shape[0]
+            mean_b = these.mean(axis=0)
+            m2_b = ((these - mean_b)**2).sum(axis=0)
+
+            n_a = self.n[i]
+            n = n_a + n_b
+            delta = mean_b - self.mean[:, i]
+            self.mean[:, i] += delta * n_b / n
+            self.m2[:, i] += m2_b + delta**2 * n_a * n_b / n
+            self.n[i] = n
+
+            self.trace_sum[i] += traces[idx == i, :, :nframes].sum(axis=0)
+
+        not_blank = conds != self.blank
+        if not_blank.any():
+            self.min_resp = np.minimum(self.min_resp, resp[not_blank].min(axis=0))
+
+        self.trials += conds.size
+
+    @property
+    def mean_traces(self):
+        """Mean trace for each condition, conds x cells x time."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.trace_sum / self.n[:, None, None]
+
+    @property
+    def pvals(self):
+        """1-way ANOVA p-value across conditions for each cell."""
+        seen = self.n > 0
+        n, mean, m2 = self.n[seen], self.mean[:, seen], self.m2[:, seen]
+        k = n.size
+        N = n.sum()
+        if k < 2 or N <= k:
+            return np.full(self.mean.shape[0], np.nan)
+        grand = (mean * n).sum(axis=1, keepdims=True) / N
+        ssb = (n * (mean - grand)**2).sum(axis=1)
+        ssw = m2.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f_val = (ssb / (k - 1)) / (ssw / (N - k))
+        return stats.f.sf(f_val, k - 1, N - k)
+
+    def _ori_means(self):
+        """Trial weighted mean response by orientation (mod 180), blanks dropped."""
+        keep = (self.conds != self.blank) & (self.n > 0)
+        oris = self.conds[keep] % 180
+        uoris = np.unique(oris)
+        weights = (oris[:, None] == uoris[None, :]) * self.n[keep][:, None] # conds x oris
+        ori_means = self.mean[:, keep] @ weights / weights.sum(axis=0)
+        return uoris, ori_means
+
+    def summary(self):
+        """
+        Current tuning for every cell.
+
+        Returns:
+            pd.DataFrame: indexed by cell with vis_resp, pval, pref, ortho, pdir, osi
+        """
+        pvals = self.pvals
+        uoris, ori_means = self._ori_means()
+
+        pref_idx = ori_means.argmax(axis=1)
+        pref = uoris[pref_idx]
+        ortho = (pref - 90) % 180
+
+        keep = (self.conds != self.blank) & (self.n > 0)
+        pdirs = self.conds[keep][self.mean[:, keep].argmax(axis=1)]
+
+        # same as osi(): min subtract, then compare pref to ortho
+        cells = np.arange(ori_means.shape[0])
+        ortho_idx = np.searchsorted(uoris, ortho).clip(max=uoris.size - 1)
+        has_ortho = uoris[ortho_idx] == ortho
+        po = ori_means[cells, pref_idx] - self.min_resp
+        oo = np.where(has_ortho, ori_means[cells, ortho_idx], np.nan) - self.min_resp
+        with np.errstate(invalid='ignore', divide='ignore'):
+            osis = _osi(po, oo)
+
+        return pd.DataFrame({
+            'vis_resp': pvals < self.p,
+            'pval': pvals,
+            'pref': pref,
+            'ortho': ortho,
+            'pdir': pdirs,
+            'osi': osis,
+        }, index=pd.Index(cells, name='cell'))
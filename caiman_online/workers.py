@@ -0,0 +1,245 @@
+"""
+Process-wide caiman worker pool. Starting a cluster spawns processes and imports caiman in each of
+them, which takes tens of seconds, so the same pool is shared by every batch, segmentation run and
+session in a process instead of being started and stopped by each of them. FitScheduler takes
+turns running fits from several sessions at once.
+"""
+
+import asyncio
+import atexit
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', category=FutureWarning)
+    import caiman as cm
+
+from .wscomm import WebSocketAlert
+from .utils import tic, toc
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _ping(x):
+    """Trivial job used to check that workers are alive and responding."""
+    return x
+
+
+class WorkerPool:
+    """
+    Wraps a caiman cluster (dview) so it can be started once and reused. Use get_pool() instead of
+    making these directly so the whole process shares one.
+
+    backend = caiman cluster backend, defaults to 'local' (multiprocessing)
+    n_processes = number of worker processes, defaults to None (let caiman decide)
+    health_timeout = seconds to wait on a ping before the pool is considered dead
+    """
+    def __init__(self, backend='local', n_processes=None, health_timeout=10):
+        self.backend = backend
+        self.requested_processes = n_processes
+        self.health_timeout = health_timeout
+
+        self.c = None
+        self.dview = None
+        self.n_processes = None
+        self.restarts = 0
+        self._lock = threading.RLock()
+
+    @property
+    def running(self):
+        return self.dview is not None
+
+    def start(self):
+        """Starts the cluster if it isn't already running."""
+        with self._lock:
+            if self.running:
+                return self
+            t = tic()
+            print('Starting local cluster...', end=' ')
+            self.c, self.dview, self.n_processes = cm.cluster.setup_cluster(
+                backend=self.backend, n_processes=self.requested_processes, single_thread=False)
+            print(f'done. Took {toc(t):.4f}s')
+            return self
+
+    def stop(self):
+        """Stops the cluster. Safe to call on a pool that is already stopped."""
+        with self._lock:
+            if not self.running:
+                return
+            try:
+                cm.stop_server(dview=self.dview)
+            except Exception as e:
+                WebSocketAlert(f'Problem stopping cluster: {e}', 'warn')
+            self.c = None
+            self.dview = None
+
+    def restart(self):
+        """Tears down and restarts the cluster."""
+        with self._lock:
+            WebSocketAlert('Restarting worker pool...', 'warn')
+            self.stop()
+            self.restarts += 1
+            return self.start()
+
+    def is_healthy(self):
+        """
+        Checks the workers by sending each one a trivial job.
+
+        Returns:
+            bool: True if every worker answered before health_timeout
+        """
+        with self._lock:
+            if not self.running:
+                return False
+            try:
+                if hasattr(self.dview, 'map_async'):
+                    # multiprocessing pool
+                    res = self.dview.map_async(_ping, range(self.n_processes)).get(self.health_timeout)
+                else:
+                    # ipyparallel view
+                    res = self.dview.map_sync(_ping, range(self.n_processes))
+                return list(res) == list(range(self.n_processes))
+            except Exception:
+                return False
+
+    def map(self, func, iterable):
+        """
+        Runs func on each item across the workers. func has to be a top-level (picklable) function.
+
+        Returns:
+            list: results in the same order as iterable
+        """
+        if hasattr(self.dview, 'map_async'):
+            return list(self.dview.map(func, iterable))
+        return list(self.dview.map_sync(func, iterable))
+
+    def ensure(self):
+        """
+        Makes sure the pool is up and responding, (re)starting it if needed. Call this before
+        handing dview off to a long-running job.
+
+        Returns:
+            WorkerPool: self, for chaining (eg. get_pool().ensure().dview)
+        """
+        with self._lock:
+            if not self.running:
+                return self.start()
+            if not self.is_healthy():
+                WebSocketAlert('Worker pool failed health check.', 'error')
+                return self.restart()
+            return self
+
+
+def get_pool(backend='local', n_processes=None):
+    """
+    Gets the process-wide worker pool, starting it the first time it's asked for. Args are only
+    used when the pool is first made.
+
+    Returns:
+        WorkerPool: the shared pool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(backend=backend, n_processes=n_processes)
+        return _pool.start()
+
+
+def shutdown_pool():
+    """Stops the shared pool. Registered to run when the interpreter exits."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.stop()
+            _pool = None
+
+
+atexit.register(shutdown_pool)
+
+
+class FitScheduler:
+    """
+    Runs fits from several sessions on a fixed number of fit threads. Sessions take turns: when a
+    thread frees up it goes to the next session in line that has a fit waiting, so a session with a
+    backlog can't hold up the others. Use from the event loop the sessions run on.
+
+    slots = fits that can run at once, defaults to 1
+    """
+    def __init__(self, slots=1):
+        self.slots = slots
+        self.executor = ThreadPoolExecutor(max_workers=slots, thread_name_prefix='caiman-fit')
+        self.queues = {} # session -> deque of (func, info, future)
+        self.turns = deque() # sessions with fits waiting, in the order they get the next thread
+        self.running = 0
+        self.fits_done = {} # session -> number of fits run, for checking how fair it was
+        self._active = [] # info dicts of the fits running right now
+        self._active_lock = threading.Lock()
+
+    async def run(self, session, func, info=None):
+        """
+        Queues func() for session and waits for it to run on a fit thread.
+
+        Args:
+            session: the session the fit is for
+            func: the fit, called with no arguments
+            info (dict, optional): gets 'shared' set to whether another fit was running at any
+                                   point while this one ran
+
+        Returns:
+            whatever func returns
+        """
+        if info is None:
+            info = {}
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(session, deque()).append((func, info, future))
+        if session not in self.turns:
+            self.turns.append(session)
+        self._dispatch()
+        return await future
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self.running < self.slots and self.turns:
+            session = self.turns.popleft()
+            queue = self.queues[session]
+            func, info, future = queue.popleft()
+            if queue:
+                # more waiting, back of the line
+                self.turns.append(session)
+            if future.cancelled():
+                continue
+            self.running += 1
+            fit = loop.run_in_executor(self.executor, self._tracked, func, info)
+            fit.add_done_callback(partial(self._fit_done, session, future))
+
+    def _tracked(self, func, info):
+        with self._active_lock:
+            info['shared'] = bool(self._active)
+            for other in self._active:
+                other['shared'] = True
+            self._active.append(info)
+        try:
+            return func()
+        finally:
+            with self._active_lock:
+                self._active.remove(info)
+
+    def _fit_done(self, session, future, fit):
+        self.running -= 1
+        self.fits_done[session] = self.fits_done.get(session, 0) + 1
+        if fit.cancelled():
+            future.cancel()
+        elif not future.cancelled():
+            if fit.exception() is not None:
+                future.set_exception(fit.exception())
+            else:
+                future.set_result(fit.result())
+        self._dispatch()
+
+    def close(self):
+        """Waits for running fits and stops the fit threads."""
+        self.executor.shutdown(wait=True)
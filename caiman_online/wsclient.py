@@ -1,14 +1,17 @@
 import asyncio
+import copy
 import websockets
-import matplotlib.pyplot as plt
 from termcolor import cprint
+import numpy as np
 import pandas as pd
 import json
 import os
 
-from .plot import make_ori_figure, plot_ori_dists
+from .plot import LiveDashboard
 from .analysis import process_data
-from .vis import run_pipeline, create_df
+from .protocol import ResultAssembler, unpack_result
+from .timing import resample_trials
+from .vis import IncrementalTuning
 
 # check this
 path = 'E:/caiman_scratch/results'
@@ -16,33 +19,69 @@ os.chdir(path)
 
 class DaqClient:
     
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, session=None):
         self.ip = ip
         self.port = port
         self.url = f'ws://{ip}:{port}'
+        self.session = session # session ID to subscribe to on a MultiSessionServer
         
         self.acqs_recvd = 0
+        self.assembler = ResultAssembler()
+        self.analysis_window = (0.2, 0.8, 1.4, 2.0)
+        self.tuning = None
+        self.dashboard = LiveDashboard(min_interval=1.0)
         
         cprint(f'[INFO] Starting DAQ WS Client at {self.url}', 'yellow')
         self.loop = asyncio.get_event_loop()
+        self.loop.create_task(self.run_plots())
         self.loop.run_until_complete(self.run_ws())
         asyncio.get_event_loop().run_forever()
         
     async def run_ws(self):
         """
-        Starts the WS Client.
+        Starts the WS Client. Subscribes to caiman results and handles them as they are pushed.
+        """
+        async with websockets.connect(self.url) as websocket:
+            self.websocket = websocket
+            subscribe = 'subscribe'
+            if self.session is not None:
+                subscribe = {'session': self.session, 'message': subscribe}
+            await websocket.send(json.dumps(subscribe))
+            try:
+                async for data in websocket:
+                    if isinstance(data, bytes):
+                        self.handle_result_frame(data)
+                    else:
+                        self.handle_incoming(data)
+            except websockets.ConnectionClosed:
+                cprint('[WARNING] WS connection terminated!', 'red')
+        print('quitting...')
+        self.loop.stop()
+        
+    async def run_plots(self, interval=0.1):
+        """
+        Redraws the dashboard whenever there are new results, separately from handling them. This
+        still draws on the event loop's thread (GUI backends need the main thread), so messages wait
+        while a redraw runs. Redraws are kept short by blitting and to one per min_interval, and
+        anything that comes in meanwhile is buffered by the websocket.
         """
         while True:
-            # try:
-            async with websockets.connect(self.url) as websocket:
-                self.websocket = websocket
-                data = await websocket.recv()
-                self.handle_incoming(data)
-        #     except websockets.ConnectionClosed:
-        #         cprint('[WARNING] WS connection terminated!', 'red')
-        #         break
-        # print('quitting...')
-        # self.loop.stop()
+            self.dashboard.render()
+            await asyncio.sleep(interval)
+        
+    def handle_result_frame(self, frame):
+        """
+        Handles a binary result frame (see protocol.py). Runs the analysis once all the planes of
+        a batch are in.
+        """
+        header, arrays = unpack_result(frame)
+        if header['kind'] != 'cm_result':
+            cprint(f'[WARNING] unknown frame kind {header["kind"]}', 'yellow')
+            return
+        
+        for batch in self.assembler.add(header, arrays):
+            self.acqs_recvd += len(batch['splits'])
+            self.handle_data(batch)
         
     def handle_incoming(self, data):
         data = json.loads(data)
@@ -64,37 +103,63 @@ class DaqClient:
             else:
                 # event not specified
                 print('[WARNING] unknown event! printing data.', 'yellow')
-        
-        elif isinstance(data, dict):
-            if data.pop('kind') == 'cm_result':
-                self.handle_data(data)
-
                 
     def handle_data(self, data):
-        
+        """
+        Adds a new batch to the running tuning stats, then queues the plots and saves the updated
+        results. Only the new trials get processed. Preview batches are shown on top of a copy of
+        the stats, so the full fit of the same batch replaces them instead of counting twice.
+
+        Each batch is normalized ('scale') on its own before its trials are added, so responses
+        are in per-batch units and the merged stats only approximate normalizing the whole session
+        at once (as run_pipeline on the saved data does).
+        """
         print('got data')
-        plt.close('all')
-        
-        analysis_window = (0.2, 0.8, 1.4, 2.0)
-        traces = process_data(data['c'], data['splits'])
-        
-        df = create_df(traces, data['stim_conds'], 'ori')
-        df, mdf = run_pipeline(df, analysis_window)
         
-        plt.close('all')
-        
-        make_ori_figure(df, mdf)
-        plot_ori_dists(mdf)
-        
-        # save output data
-        # but maybe save it when it is quit gracefully
-        cell_df = mdf.groupby('cell').mean()[
-            ['vis_resp', 'pval', 'pref', 'ortho', 'pdir', 'osi']
-        ]
-        
-        locs = pd.DataFrame(json.loads(data['coords']))['CoM']
-        locs.index = locs.index.astype('int64')
+        if not data['vis_cond']:
+            cprint('[WARNING] no trial conditions with this batch, skipping stats.', 'yellow')
+            return
         
+        if data['preview']:
+            # previews can be subsampled in time, don't let one set the frame rate for the session
+            if self.tuning is None:
+                tuning = IncrementalTuning(self.analysis_window, fr=data['fr'])
+            else:
+                tuning = copy.deepcopy(self.tuning)
+        else:
+            if self.tuning is None:
+                self.tuning = IncrementalTuning(self.analysis_window, fr=data['fr'])
+            tuning = self.tuning
+        
+        if data.get('frame_times') is not None:
+            traces = process_data(data['c'], data['splits'], trial_mode='time',
+                                  frame_times=data['frame_times'], fr=data['fr'])
+        else:
+            traces = process_data(data['c'], data['splits'])
+        
+        if tuning.fr and data['fr'] and not np.isclose(tuning.fr, data['fr']):
+            traces = resample_trials(traces, data['fr'], tuning.fr)
+        
+        # only trials that have a condition (and frames) count
+        conds = np.asarray(data['vis_cond'], dtype=float)[:traces.shape[0]]
+        traces = traces[:conds.size]
+        keep = ~np.isnan(conds) & ~np.isnan(traces).all(axis=(1, 2))
+        if not keep.any():
+            cprint('[WARNING] no trials with conditions in this batch, skipping stats.', 'yellow')
+            return
+        if not keep.all() or conds.size < len(data['splits']):
+            cprint(f'[WARNING] only {keep.sum()} of {len(data["splits"])} trials have conditions.', 'yellow')
+        tuning.add_trials(traces[keep], conds[keep])
+        
+        cell_df = tuning.summary()
+        n = cell_df.vis_resp.sum()
+        kind = 'preview' if data['preview'] else 'fit'
+        print(f'There are {n} visually responsive cells, out of {cell_df.shape[0]} ({tuning.trials} trials, {kind})')
+        
+        # drawn by run_plots
+        self.dashboard.update(cell_df, tuning.mean_traces, tuning.conds)
+        
+        locs = pd.Series(data['com'], name='CoM')
         cell_df = cell_df.join(locs)
         
         # saves it as a CSV that can be read in by MATLAB readtable()
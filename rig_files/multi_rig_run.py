@@ -0,0 +1,49 @@
+"""
+Runs caiman for two rigs at once on one analysis computer. Each rig's ScanImage/DAQ scripts send
+their messages with their own session ID (set CAIMAN_SESSION, or SESSION in networking.py, on
+that rig), and results are only pushed to DAQ clients subscribed with that session.
+"""
+from caiman_online.server import MultiSessionServer
+from caiman_online.main import OnlineAnalysis
+
+from franken_rig_run import caiman_params
+
+ip = '192.168.10.104'
+port = 5003
+fit_slots = 1 # fits that can run at the same time, across both rigs
+
+rigs = {
+    'franken': {
+        'template_path': 'D:/caiman_temp/template/makeMasks3D_img.mat',
+        'srv_folder': 'F:/caiman_out/franken',
+        'tiffs_per_batch': 10,
+        'image_params': {
+            'channels': 2,
+            'planes': 3,
+            'x_start': 100,
+            'x_end': 400,
+            'folder': 'D:/caiman_temp/franken/',
+        },
+    },
+    'satsuma': {
+        'template_path': 'D:/caiman_temp/template_satsuma/makeMasks3D_img.mat',
+        'srv_folder': 'F:/caiman_out/satsuma',
+        'tiffs_per_batch': 10,
+        'image_params': {
+            'channels': 2,
+            'planes': 3,
+            'x_start': 100,
+            'x_end': 400,
+            'folder': 'D:/caiman_temp/satsuma/',
+        },
+    },
+}
+
+# run everything
+if __name__ == '__main__':
+    srv = MultiSessionServer(ip, port, fit_slots=fit_slots)
+    for session_id, rig in rigs.items():
+        expt = OnlineAnalysis(caiman_params, **rig['image_params'])
+        expt.make_templates(rig['template_path'])
+        srv.add_session(session_id, expt, rig['srv_folder'], batch_size=rig['tiffs_per_batch'])
+    srv.run()